@@ -20,6 +20,8 @@ def cms_app_urls_changed(**kwargs):
         pass
 
     clear_url_caches()
+    from django_harness.fast_dispatch import clear_resolver_cache
+    clear_resolver_cache()
 
     import cms.urls
     reload(cms.urls)
@@ -0,0 +1,282 @@
+"""
+Micro-benchmarks for the harness itself, run on a large generated page:
+
+    python -m django_harness.benchmarks [--rows=2000] [--repeat=5] [name...]
+
+where each name is one of the benchmarks listed by --list (default: all).
+Django settings are only needed for the parts of Django that the harness
+uses, so we configure the defaults if DJANGO_SETTINGS_MODULE isn't set.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import argparse
+import collections
+import os
+import sys
+from timeit import default_timer
+
+benchmarks = collections.OrderedDict()
+
+def benchmark(function):
+    benchmarks[function.__name__] = function
+    return function
+
+def generate_page(rows):
+    """
+    A well-formed XHTML page with a form and a table of rows rows, similar
+    to a Django admin changelist.
+    """
+
+    lines = [
+        '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+            '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">',
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head>'
+            '<title>Benchmark &mdash; page</title></head><body>',
+        '<div id="header" class="header main">Header&nbsp;text</div>',
+        '<form id="changelist-form" method="post" action="">',
+        '<input type="hidden" id="id_form-TOTAL_FORMS" '
+            'name="form-TOTAL_FORMS" value="%d" />' % rows,
+        '<input type="hidden" id="id_form-INITIAL_FORMS" '
+            'name="form-INITIAL_FORMS" value="%d" />' % rows,
+        '<input type="hidden" id="id_form-MAX_NUM_FORMS" '
+            'name="form-MAX_NUM_FORMS" value="1000" />',
+        '<table id="result_list" class="results"><tbody>',
+    ]
+
+    for i in range(rows):
+        lines.append('<tr class="row%d"><td class="field-name">'
+            '<input type="text" id="id_form-%d-name" name="form-%d-name" '
+            'value="Row &amp; %d" /></td><td class="field-date">'
+            '2014&ndash;04&ndash;%02d</td><td><a href="/item/%d/">view '
+            '&raquo;</a></td></tr>' % (i % 2, i, i, i, i % 28 + 1, i))
+
+    lines.extend([
+        '</tbody></table>',
+        '<p class="errornote">Please correct the errors below.</p>',
+        '</form>',
+        '<div id="footer" class="footer">Footer</div>',
+        '</body></html>',
+    ])
+
+    return "\n".join(lines)
+
+def make_response(page):
+    from django.http import HttpResponse
+    return HttpResponse(page, content_type="text/html; charset=utf-8")
+
+def make_harness():
+    from django_harness.html_parsing import HtmlParsingMixin
+
+    class BenchmarkHarness(HtmlParsingMixin):
+        failureException = AssertionError
+
+        def assertNotEqual(self, first, second, msg=None):
+            if first == second:
+                raise self.failureException(msg)
+
+        def fail(self, msg=None):
+            raise self.failureException(msg)
+
+    return BenchmarkHarness()
+
+def best_time(function, repeat):
+    times = []
+    for i in range(repeat):
+        start = default_timer()
+        function()
+        times.append(default_timer() - start)
+    return min(times)
+
+@benchmark
+def parse(page, repeat):
+    """
+    Parse the page with each parse engine.
+    """
+
+    harness = make_harness()
+    results = []
+
+    for engine in ('xml', 'html'):
+        results.append(("parse engine=%s" % engine, best_time(
+            lambda: harness.parse(make_response(page), engine=engine),
+            repeat)))
+
+    return results
+
+SELECTORS = [
+    '#header', '#footer', 'div.header', 'div.footer', 'title',
+    '#id_form-TOTAL_FORMS', 'input[name="form-INITIAL_FORMS"]',
+    '#id_form-MAX_NUM_FORMS', 'form#changelist-form', 'p.errornote',
+    'table.results', 'tr.row1 td.field-name', 'td.field-date',
+    'a[href="/item/1/"]', 'input[name="form-7-name"]', '#id_form-0-name',
+    '#id_form-1-name', '#id_form-2-name', 'input#id_form-3-name',
+    'div#header', 'form input[type="hidden"]', 'table > tbody > tr',
+    '#result_list td.field-name', 'a[href="/item/2/"]', 'head > title',
+    'tr.row0', 'form > p.errornote', 'td.field-name > input', 'body > div',
+    'input[name="form-TOTAL_FORMS"]',
+]
+
+@benchmark
+def query(page, repeat):
+    """
+    Run a set of CSS selectors, compiled every time and cached.
+    """
+
+    harness = make_harness()
+    harness.parse_engine = 'html'
+    root = harness.parse(make_response(page.replace(
+        ' xmlns="http://www.w3.org/1999/xhtml"', '')))
+    translator = harness.translator
+
+    def uncached():
+        for selector in SELECTORS:
+            root.xpath(translator.css_to_xpath(selector))
+
+    def cached():
+        for selector in SELECTORS:
+            harness.compile_selector(selector)(root)
+
+    return [
+        ("%d selectors, uncompiled" % len(SELECTORS),
+            best_time(uncached, repeat)),
+        ("%d selectors, cached" % len(SELECTORS),
+            best_time(cached, repeat)),
+    ]
+
+@benchmark
+def query_many(page, repeat):
+    """
+    Run a set of CSS selectors one at a time, and all in one pass.
+    """
+
+    harness = make_harness()
+    harness.parse_engine = 'html'
+    root = harness.parse(make_response(page.replace(
+        ' xmlns="http://www.w3.org/1999/xhtml"', '')))
+    selectors = dict(enumerate(SELECTORS))
+
+    def one_at_a_time():
+        for selector in SELECTORS:
+            harness.query(root, selector)
+
+    return [
+        ("%d x query()" % len(SELECTORS), best_time(one_at_a_time, repeat)),
+        ("query_many()", best_time(lambda: harness.query_many(root,
+            selectors), repeat)),
+    ]
+
+@benchmark
+def parse_index(page, repeat):
+    """
+    Build a parse-time element index, and use it for simple queries.
+    """
+
+    from django_harness.html_parsing import parse_simple_selector
+
+    harness = make_harness()
+    harness.parse_engine = 'html'
+    page = page.replace(' xmlns="http://www.w3.org/1999/xhtml"', '')
+    response = make_response(page)
+    harness.parse(response, index=True)
+    unindexed = make_response(page)
+    harness.parse(unindexed, index=False)
+
+    simple = [selector for selector in SELECTORS
+        if parse_simple_selector(selector)]
+
+    def run_queries(response):
+        harness.assert_get_management_form(response, 'form')
+        for selector in simple:
+            harness.query(response, selector)
+
+    return [
+        ("parse", best_time(lambda: harness.parse(make_response(page),
+            index=False), repeat)),
+        ("parse and index", best_time(lambda: harness.parse(
+            make_response(page), index=True), repeat)),
+        ("%d queries, unindexed" % (len(simple) + 3),
+            best_time(lambda: run_queries(unindexed), repeat)),
+        ("%d queries, indexed" % (len(simple) + 3),
+            best_time(lambda: run_queries(response), repeat)),
+    ]
+
+@benchmark
+def stream_query(page, repeat):
+    """
+    Find an element near the start and end of the page, by parsing the
+    whole page and by streaming.
+    """
+
+    harness = make_harness()
+    harness.parse_engine = 'html'
+    page = page.replace(' xmlns="http://www.w3.org/1999/xhtml"', '')
+    results = []
+
+    for selector in ('#header', '#footer'):
+        results.append(("parse and query %s" % selector, best_time(
+            lambda: harness.query(make_response(page), selector), repeat)))
+        results.append(("stream_query %s" % selector, best_time(
+            lambda: harness.stream_query(make_response(page),
+                {'element': selector}), repeat)))
+
+    return results
+
+@benchmark
+def html_compare(page, repeat):
+    """
+    Count a needle in the page, as assertInHTML does, with Django's HTML
+    comparison (only run once, as it's slow) and html_compare.
+    """
+
+    from django.test.html import parse_html
+    from django_harness.html_compare import count_in_html
+
+    needle = '<p class="errornote">Please correct the errors below.</p>'
+
+    return [
+        ("django.test.html", best_time(
+            lambda: parse_html(page).count(parse_html(needle)), 1)),
+        ("html_compare", best_time(lambda: count_in_html(needle, page),
+            repeat)),
+    ]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the harness "
+        "on a large generated page.")
+    parser.add_argument('names', nargs='*', help="benchmarks to run "
+        "(default: all)")
+    parser.add_argument('--rows', type=int, default=2000,
+        help="number of table rows in the generated page (default: 2000)")
+    parser.add_argument('--repeat', type=int, default=5,
+        help="number of times to run each benchmark, reporting the best "
+        "(default: 5)")
+    parser.add_argument('--list', action='store_true',
+        help="list the available benchmarks")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, function in benchmarks.iteritems():
+            print "%-20s %s" % (name, function.__doc__.strip())
+        return 0
+
+    from django.conf import settings
+    if not settings.configured and 'DJANGO_SETTINGS_MODULE' not in os.environ:
+        settings.configure()
+
+    page = generate_page(args.rows)
+    print "Page size: %d bytes, best of %d runs" % (len(page.encode('utf-8')),
+        args.repeat)
+
+    for name in args.names or benchmarks.keys():
+        if name not in benchmarks:
+            print "Unknown benchmark: %s" % name
+            return 1
+
+        for label, seconds in benchmarks[name](page, args.repeat):
+            print "%-40s %10.2f ms" % (label, seconds * 1000)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+Compiles CSS selectors into Python functions that test a single element,
+so that many selectors can be checked in one walk over a parsed tree,
+instead of one XPath evaluation (and tree walk) per selector.
+
+Only the common subset of CSS is supported: type, universal, #id, .class
+and [attribute] selectors, and the descendant and child combinators.
+compile_matcher() returns None for anything else (pseudo-classes,
+namespaces, sibling combinators), and the caller should fall back to XPath.
+Matching follows cssselect's GenericTranslator, so element and attribute
+names are case sensitive, and elements in a namespace only match the
+universal selector.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import collections
+
+from cssselect import parse
+from cssselect.parser import Element, Hash, Class, Attrib, CombinedSelector
+
+
+class UnsupportedSelector(Exception):
+    pass
+
+def get_classes(element):
+    return (element.get('class') or '').split()
+
+def attribute_value(value):
+    # cssselect 1.1 gives us a string, later versions a Token
+    return getattr(value, 'value', value)
+
+def compile_attribute_test(operator, value):
+    if operator == 'exists':
+        return lambda actual: actual is not None
+    elif operator == '=':
+        return lambda actual: actual == value
+    elif operator == '!=':
+        return lambda actual: actual is None or actual != value
+    elif operator == '~=':
+        if not value or len(value.split()) != 1:
+            return lambda actual: False
+        return lambda actual: actual is not None and value in actual.split()
+    elif operator == '|=':
+        return lambda actual: actual is not None and (actual == value or
+            actual.startswith(value + '-'))
+    elif operator == '^=':
+        return lambda actual: bool(value) and actual is not None and \
+            actual.startswith(value)
+    elif operator == '$=':
+        return lambda actual: bool(value) and actual is not None and \
+            actual.endswith(value)
+    elif operator == '*=':
+        return lambda actual: bool(value) and actual is not None and \
+            value in actual
+    else:
+        raise UnsupportedSelector(operator)
+
+def compile_compound(node):
+    """
+    Compiles a sequence of simple selectors, such as div.a#b[name], into a
+    list of tests, and returns (tests, index_key), where index_key is the
+    most selective ('id', value), ('attribute', (name, value)),
+    ('class', value) or ('tag', value) that every matching element must
+    have, or None if there is none.
+    """
+
+    tests = []
+    ids = []
+    attributes = []
+    classes = []
+    tag = None
+
+    while not isinstance(node, Element):
+        if isinstance(node, Hash):
+            ids.append(node.id)
+        elif isinstance(node, Class):
+            classes.append(node.class_name)
+        elif isinstance(node, Attrib):
+            if node.namespace is not None:
+                raise UnsupportedSelector(node)
+            name = node.attrib
+            value = attribute_value(node.value)
+            if node.operator == '=':
+                attributes.append((name, value))
+            test = compile_attribute_test(node.operator, value)
+            tests.append(lambda element, name=name, test=test:
+                test(element.get(name)))
+        else:
+            raise UnsupportedSelector(node)
+        node = node.selector
+
+    if node.namespace is not None:
+        raise UnsupportedSelector(node)
+
+    if node.element not in (None, '*'):
+        tag = node.element
+        tests.insert(0, lambda element: element.tag == tag)
+
+    for id in ids:
+        tests.append(lambda element, id=id: element.get('id') == id)
+
+    if classes:
+        tests.append(lambda element: all(c in get_classes(element)
+            for c in classes))
+
+    if ids:
+        index_key = ('id', ids[0])
+    elif attributes:
+        index_key = ('attribute', attributes[0])
+    elif classes:
+        index_key = ('class', classes[0])
+    elif tag is not None:
+        index_key = ('tag', tag)
+    else:
+        index_key = None
+
+    return tests, index_key
+
+def compile_tree(node):
+    """
+    Returns (match, index_key), where match(element, root) tells whether
+    element matches the selector, looking no higher than root for the
+    elements that it must be contained in.
+    """
+
+    if not isinstance(node, CombinedSelector):
+        tests, index_key = compile_compound(node)
+        def match(element, root):
+            for test in tests:
+                if not test(element):
+                    return False
+            return True
+        return match, index_key
+
+    left, ignored = compile_tree(node.selector)
+    right, index_key = compile_tree(node.subselector)
+
+    if node.combinator == ' ':
+        def match(element, root):
+            if not right(element, root) or element is root:
+                return False
+            for ancestor in element.iterancestors():
+                if left(ancestor, root):
+                    return True
+                if ancestor is root:
+                    break
+            return False
+    elif node.combinator == '>':
+        def match(element, root):
+            return right(element, root) and element is not root and \
+                left(element.getparent(), root)
+    else:
+        raise UnsupportedSelector(node.combinator)
+
+    return match, index_key
+
+Matcher = collections.namedtuple("Matcher", ["match", "index_key"])
+
+def compile_matcher(selector):
+    """
+    Returns a list of Matchers, one for each selector in a comma-separated
+    group, or None if the selector can't be matched without XPath. Raises
+    cssselect.SelectorError if the selector is invalid.
+    """
+
+    try:
+        matchers = []
+        for parsed in parse(selector):
+            if parsed.pseudo_element is not None:
+                return None
+            matchers.append(Matcher(*compile_tree(parsed.parsed_tree)))
+        return matchers
+    except UnsupportedSelector:
+        return None
+
+class MatcherSet(object):
+    """
+    A set of named selectors compiled by compile_matcher, which can all be
+    matched against a tree in one pass with match_all(), or one element at
+    a time with match() (e.g. while parsing incrementally).
+
+    Each selector is only tested against elements that have its index_key,
+    found with a few dictionary lookups per element.
+    """
+
+    def __init__(self, matchers):
+        # lists of (name, match)
+        self.unindexed = []
+        self.by_tag = {}
+        self.by_id = {}
+        self.by_class = {}
+        # attribute name => value => list of (name, match)
+        self.by_attribute = {}
+
+        for name, group in matchers.iteritems():
+            for matcher in group:
+                entry = (name, matcher.match)
+                if matcher.index_key is None:
+                    self.unindexed.append(entry)
+                    continue
+
+                kind, value = matcher.index_key
+                if kind == 'attribute':
+                    attribute, value = value
+                    self.by_attribute.setdefault(attribute, {}).setdefault(
+                        value, []).append(entry)
+                else:
+                    index = getattr(self, 'by_' + kind)
+                    index.setdefault(value, []).append(entry)
+
+        self.names = set(entry[0] for entries in [self.unindexed] +
+            self.by_tag.values() + self.by_id.values() +
+            self.by_class.values() for entry in entries)
+        self.names.update(entry[0] for values in self.by_attribute.values()
+            for entries in values.values() for entry in entries)
+
+    def get_candidates(self, element):
+        get = element.get
+        candidates = self.unindexed + self.by_tag.get(element.tag, [])
+
+        if self.by_id:
+            id = get('id')
+            if id is not None and id in self.by_id:
+                candidates += self.by_id[id]
+
+        for attribute, values in self.by_attribute.iteritems():
+            value = get(attribute)
+            if value is not None and value in values:
+                candidates += values[value]
+
+        if self.by_class:
+            classes = get('class')
+            if classes is not None:
+                for class_name in set(classes.split()):
+                    if class_name in self.by_class:
+                        candidates += self.by_class[class_name]
+
+        return candidates
+
+    def match(self, element, root, skip=()):
+        """
+        Returns the names of the selectors that element matches, except
+        for those in skip.
+        """
+
+        names = []
+        for name, match in self.get_candidates(element):
+            if name not in names and name not in skip and \
+                    match(element, root):
+                names.append(name)
+        return names
+
+    def match_all(self, root, first_only=False):
+        """
+        Returns a dictionary of name => list of matching elements, in
+        document order, for all the elements in root (including itself).
+        If first_only, stops looking for each selector after its first
+        match, and stops walking the tree once they have all matched.
+        """
+
+        from lxml import etree
+        results = {}
+        found = set() if first_only else ()
+
+        for element in root.iter(etree.Element):
+            for name in self.match(element, root, found):
+                if first_only:
+                    results[name] = [element]
+                    found.add(name)
+                else:
+                    results.setdefault(name, []).append(element)
+
+            if first_only and len(found) == len(self.names):
+                break
+
+        return results
@@ -1,13 +1,18 @@
 from __future__ import unicode_literals, absolute_import
 
 import collections
-from urlparse import urlsplit
+from timeit import default_timer
+from urlparse import urljoin, urlsplit
 
 from django.core.urlresolvers import resolve, reverse
 from django.contrib.messages.storage.fallback import FallbackStorage
 from django.contrib.auth.models import User
 from django.test.client import RequestFactory
 from django.core.files import File
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+from django_harness.helper import LazyMessage
 
 class FakeSession(collections.MutableMapping):
     """
@@ -39,63 +44,355 @@ class FakeSession(collections.MutableMapping):
     def set_test_cookie(self):
         pass
 
-class FastDispatchMixin(object):
+class ResolverCache(object):
+    """
+    Remembers the path and ResolverMatch for each combination of view name,
+    URL arguments, active language and URL configuration that fast_dispatch
+    has seen, so that we only reverse() and resolve() each one once.
 
-    default_cms_page = None
+    Cleared whenever Django's own URL caches are cleared by
+    override_settings.root_urlconf_changed or
+    app_testing.cms_app_urls_changed.
+    """
 
-    def get_fake_request(self, path, method='get', get_params=None, 
-        post_params=None, request_extras=None, file_params=None):
+    def __init__(self):
+        self.store = dict()
+        self.hits = 0
+        self.misses = 0
 
-        get_params  = get_params  if get_params  else {}
-        post_params = post_params if post_params else {}
-        file_params = file_params if file_params else {}
+    def make_key(self, view_name, url_args, url_kwargs):
+        from django.conf import settings
+        from django.core.urlresolvers import get_script_prefix, get_urlconf
+        from django.utils.translation import get_language
 
-        factory = RequestFactory()
-        handler = getattr(factory, method)
-        request = handler(path, post_params)
+        return (view_name, tuple(url_args),
+            tuple(sorted(url_kwargs.iteritems())), get_language(),
+            get_urlconf() or settings.ROOT_URLCONF, get_script_prefix())
 
-        request.GET = request.GET.copy()
-        for key, value in get_params.iteritems():
-            if hasattr(value, '__iter__'):
-                request.GET.setlist(key, value)
-            else:
-                if not isinstance(value, basestring):
-                    raise Exception("GET and POST can only contain strings, "
-                        "but %s = %s (%s)" % (key, value, value.__class__))
-                request.GET.setlist(key, [value])
-
-        request.POST = request.POST.copy()
-        for key, value in post_params.iteritems():
-            if isinstance(value, File):
-                request.FILES.setlist(key, [value])
-            elif hasattr(value, '__iter__'):
-                request.POST.setlist(key, value)
-            else:
-                if not isinstance(value, basestring):
-                    raise Exception("GET and POST can only contain strings, "
-                        "but %s = %s (%s)" % (key, value, value.__class__))
-                request.POST.setlist(key, [value])
+    def reverse_and_resolve(self, view_name, url_args, url_kwargs):
+        try:
+            key = self.make_key(view_name, url_args, url_kwargs)
+            cached = self.store.get(key)
+        except TypeError:
+            # unhashable URL arguments: don't try to cache them
+            key = cached = None
+
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        path = reverse(view_name, args=url_args, kwargs=url_kwargs)
+        resolved = (path, resolve(path))
+
+        if key is not None:
+            self.store[key] = resolved
+
+        return resolved
+
+    def resolve_path(self, path):
+        """
+        Returns the ResolverMatch for path, e.g. a form's action.
+        """
+
+        key = ('path',) + self.make_key(path, [], {})
+        resolved = self.store.get(key)
+
+        if resolved is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            resolved = resolve(path)
+            self.store[key] = resolved
+
+        return resolved
 
-        for key, value in file_params.iteritems():
-            request.FILES.setlist(key, [value])
+    def clear(self):
+        self.store.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self.store))
+
+resolver_cache = ResolverCache()
+
+def clear_resolver_cache():
+    resolver_cache.clear()
+
+# Incremented whenever a setting is changed, e.g. by override_settings, so
+# that anything derived from settings knows when to recalculate itself.
+_settings_generation = 0
+
+@receiver(setting_changed)
+def increment_settings_generation(**kwargs):
+    global _settings_generation
+    _settings_generation += 1
+
+def get_settings_generation():
+    return _settings_generation
+
+class RequestTemplate(object):
+    """
+    Everything that get_fake_request needs that depends only on the
+    settings, worked out once per test class (and settings generation)
+    rather than once per request. new_request() then only has to apply
+    the parameters that differ between requests.
+    """
+
+    def __init__(self):
+        from django.conf import settings
+        from django.utils.importlib import import_module
+
+        self.generation = get_settings_generation()
+        self.factory = RequestFactory()
+        self.session_engine = import_module(settings.SESSION_ENGINE)
+        self.use_auth = ('django.contrib.auth.middleware.AuthenticationMiddleware'
+            in settings.MIDDLEWARE_CLASSES)
+        self.attributes = {}
+
+        if 'django.middleware.locale.LocaleMiddleware' in settings.MIDDLEWARE_CLASSES:
+            self.attributes['LANGUAGE_CODE'] = settings.LANGUAGE_CODE
+
+    def is_current(self):
+        return self.generation == get_settings_generation()
+
+    def set_params(self, query_dict, key, value, files=None):
+        if files is not None and isinstance(value, File):
+            files.setlist(key, [value])
+        elif hasattr(value, '__iter__'):
+            query_dict.setlist(key, value)
+        else:
+            if not isinstance(value, basestring):
+                raise Exception("GET and POST can only contain strings, "
+                    "but %s = %s (%s)" % (key, value, value.__class__))
+            query_dict.setlist(key, [value])
+
+    def new_request(self, path, method='get', get_params=None,
+        post_params=None, file_params=None):
+
+        handler = getattr(self.factory, method)
+        request = handler(path, post_params or {})
+
+        # Only copy the QueryDicts if we need to change them.
+        if get_params:
+            request.GET = request.GET.copy()
+            for key, value in get_params.iteritems():
+                self.set_params(request.GET, key, value)
+
+        if post_params:
+            request.POST = request.POST.copy()
+            for key, value in post_params.iteritems():
+                self.set_params(request.POST, key, value, request.FILES)
+
+        if file_params:
+            for key, value in file_params.iteritems():
+                request.FILES.setlist(key, [value])
 
         # Make them immutable to catch abuses that otherwise would only
         # appear in real life, not in the tests.
         request.GET._mutable = False
         request.POST._mutable = False
 
+        request.__dict__.update(self.attributes)
         request.session = FakeSession()
         request._messages = FallbackStorage(request)
 
+        return request
+
+class MiddlewareChain(object):
+    """
+    Instances of a subset of settings.MIDDLEWARE_CLASSES, in the same order
+    as the settings, which fast_dispatch can run around the view in the same
+    way as django.core.handlers.base.BaseHandler.get_response, but without
+    URL resolution or error handling.
+    """
+
+    def __init__(self, middleware_paths):
         from django.conf import settings
+        from django.core.exceptions import MiddlewareNotUsed
+        from django.utils.importlib import import_module
+
+        if middleware_paths is True:
+            middleware_paths = settings.MIDDLEWARE_CLASSES
+
+        for path in middleware_paths:
+            if path not in settings.MIDDLEWARE_CLASSES:
+                raise Exception("Can't emulate middleware %s because it's not "
+                    "in MIDDLEWARE_CLASSES: %s" % (path,
+                        settings.MIDDLEWARE_CLASSES))
+
+        # LocaleMiddleware activates the language that the request asks for
+        self.uses_locale = ('django.middleware.locale.LocaleMiddleware' in
+            middleware_paths)
+
+        self.request_middleware = []
+        self.view_middleware = []
+        self.template_response_middleware = []
+        self.response_middleware = []
+        self.exception_middleware = []
+
+        for path in settings.MIDDLEWARE_CLASSES:
+            if path not in middleware_paths:
+                continue
+
+            module_name, _, class_name = path.rpartition('.')
+            mw_class = getattr(import_module(module_name), class_name)
+
+            try:
+                mw_instance = mw_class()
+            except MiddlewareNotUsed:
+                continue
+
+            if hasattr(mw_instance, 'process_request'):
+                self.request_middleware.append(mw_instance.process_request)
+            if hasattr(mw_instance, 'process_view'):
+                self.view_middleware.append(mw_instance.process_view)
+            if hasattr(mw_instance, 'process_template_response'):
+                self.template_response_middleware.insert(0,
+                    mw_instance.process_template_response)
+            if hasattr(mw_instance, 'process_response'):
+                self.response_middleware.insert(0,
+                    mw_instance.process_response)
+            if hasattr(mw_instance, 'process_exception'):
+                self.exception_middleware.insert(0,
+                    mw_instance.process_exception)
+
+    def get_response(self, request, view, args, kwargs):
+        response = None
+
+        for middleware_method in self.request_middleware:
+            response = middleware_method(request)
+            if response:
+                break
+
+        if response is None:
+            for middleware_method in self.view_middleware:
+                response = middleware_method(request, view, args, kwargs)
+                if response:
+                    break
+
+        if response is None:
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception as e:
+                for middleware_method in self.exception_middleware:
+                    response = middleware_method(request, e)
+                    if response:
+                        break
+                if response is None:
+                    raise
+
+        if hasattr(response, 'render') and callable(response.render):
+            for middleware_method in self.template_response_middleware:
+                response = middleware_method(request, response)
+            response = response.render()
+
+        for middleware_method in self.response_middleware:
+            response = middleware_method(request, response)
+
+        return response
+
+def set_request_language(request, language):
+    """
+    Makes the request ask for language, with a cookie and an
+    Accept-Language header, so that LocaleMiddleware activates it instead of
+    replacing the language that fast_dispatch was asked to use.
+    """
+
+    from django.conf import settings
+
+    session_language = request.session.get('django_language')
+    if session_language is not None and session_language != language:
+        raise Exception("Can't dispatch in language %s because the session "
+            "selects %s, which LocaleMiddleware would use instead" %
+            (language, session_language))
+
+    cookies = dict(request.COOKIES)
+    cookies[settings.LANGUAGE_COOKIE_NAME] = language
+    request.COOKIES = cookies
+    request.META['HTTP_ACCEPT_LANGUAGE'] = language
+
+# MiddlewareChains are expensive to create, so we keep them until the
+# settings change.
+_middleware_chains = {}
+_middleware_chains_generation = None
+
+def get_middleware_chain(middleware_paths):
+    global _middleware_chains_generation
+
+    if _middleware_chains_generation != get_settings_generation():
+        _middleware_chains.clear()
+        _middleware_chains_generation = get_settings_generation()
+
+    if middleware_paths is not True:
+        middleware_paths = tuple(middleware_paths)
+
+    chain = _middleware_chains.get(middleware_paths)
+    if chain is None:
+        chain = MiddlewareChain(middleware_paths)
+        _middleware_chains[middleware_paths] = chain
 
-        if 'django.contrib.auth.middleware.AuthenticationMiddleware' in settings.MIDDLEWARE_CLASSES:
+    return chain
+
+DispatchResult = collections.namedtuple("DispatchResult",
+    ["response", "request", "elapsed"])
+
+class FastDispatchMixin(object):
+
+    default_cms_page = None
+
+    # Set to a list of MIDDLEWARE_CLASSES entries (or True for all of them)
+    # to have fast_dispatch run them around the view by default. Note that
+    # AuthenticationMiddleware takes the user from the session, not from
+    # self.user.
+    fast_dispatch_middleware = None
+
+    # Set to True to stop fast_dispatch from keeping references to the last
+    # request (and its session and uploaded files) on the view function, or
+    # in self.last_request, which is None in this mode.
+    leak_free_dispatch = False
+
+    last_request = None
+    last_request_path = None
+
+    def get_request_template(self):
+        """
+        Returns the RequestTemplate for this test class, creating a new one
+        if there isn't one yet or the settings have changed since.
+        """
+
+        cls = self.__class__
+        template = cls.__dict__.get('_request_template')
+
+        if template is None or not template.is_current():
+            template = RequestTemplate()
+            cls._request_template = template
+
+        return template
+
+    def get_fake_request(self, path, method='get', get_params=None, 
+        post_params=None, request_extras=None, file_params=None,
+        request_template=None):
+
+        if request_template is None:
+            request_template = self.get_request_template()
+
+        request = request_template.new_request(path, method, get_params,
+            post_params, file_params)
+
+        # Share the session created by stuff_session with the test client
+        session_key = getattr(self, 'stuffed_session_key', None)
+        if session_key is not None:
+            request.session = request_template.session_engine.SessionStore(
+                session_key)
+
+        if request_template.use_auth:
             from django.contrib.auth.models import AnonymousUser
             request.user = getattr(self, 'user', AnonymousUser())
 
-        if 'django.middleware.locale.LocaleMiddleware' in settings.MIDDLEWARE_CLASSES:
-            request.LANGUAGE_CODE = settings.LANGUAGE_CODE
-
         # Resources filter plugin tests use this a lot.
         request.current_page = self.default_cms_page
 
@@ -107,30 +404,312 @@ class FastDispatchMixin(object):
 
         return request
 
-    def fast_dispatch(self, view_name, method='get', url_args=None, 
+    def set_middleware_session(self, request):
+        """
+        Sets the session cookie of a request that will go through
+        middleware, so that SessionMiddleware loads the session shared with
+        the test client by stuff_session, or else a session logged in as
+        self.user (if any), so that AuthenticationMiddleware finds the same
+        user that fast_dispatch attaches to requests without middleware.
+        """
+
+        from django.conf import settings
+
+        session_key = getattr(self, 'stuffed_session_key', None)
+        user = getattr(self, 'user', None)
+
+        if session_key is None and user is not None and \
+                user.is_authenticated():
+            # created once per test and user
+            cached = getattr(self, 'middleware_user_session', None)
+            if cached is not None and cached[0] is user:
+                session_key = cached[1]
+            else:
+                engine = self.get_request_template().session_engine
+                store = engine.SessionStore()
+                self.stuff_session_login(store, user)
+                store.save()
+                session_key = store.session_key
+                self.middleware_user_session = (user, session_key)
+
+        if session_key is not None:
+            cookies = dict(request.COOKIES)
+            cookies[settings.SESSION_COOKIE_NAME] = session_key
+            request.COOKIES = cookies
+
+    def fast_dispatch(self, view_name=None, method='get', url_args=None, 
+        url_kwargs=None, post_params=None, get_params=None, language=None,
+        request_extras=None, file_params=None, middleware=None,
+        profile_queries=False, max_queries=None, profile_templates=False,
+        path=None):
+
+        """
+        Call the view directly, without going through the test client.
+        The view is found by reversing view_name, or by resolving path
+        instead if it's given.
+
+        If profile_queries is True, or max_queries is set, the queries run
+        by the view (and by rendering its response) are attached to the
+        response as a QueryReport in response.query_report, and the test
+        fails if there were more than max_queries of them.
+
+        If middleware includes LocaleMiddleware, the request asks for
+        language (if given), so that the middleware activates it.
+        """
+
+        response, request = self._fast_dispatch(view_name, method=method,
+            url_args=url_args, url_kwargs=url_kwargs, post_params=post_params,
+            get_params=get_params, language=language,
+            request_extras=request_extras, file_params=file_params,
+            middleware=middleware, profile_queries=profile_queries,
+            max_queries=max_queries, profile_templates=profile_templates,
+            path=path)
+        return response
+
+    def _fast_dispatch(self, view_name, method='get', url_args=None,
         url_kwargs=None, post_params=None, get_params=None, language=None,
-        request_extras=None, file_params=None):
+        request_extras=None, file_params=None, middleware=None,
+        profile_queries=False, max_queries=None, profile_templates=False,
+        path=None, request_template=None, render=False):
 
         url_args    = url_args    if url_args    else []
         url_kwargs  = url_kwargs  if url_kwargs  else {}
 
+        profilers = []
+
+        if profile_queries or max_queries is not None:
+            from django_harness.query_profiling import QueryProfiler
+            query_profiler = QueryProfiler()
+            profilers.append(query_profiler)
+
+        if profile_templates:
+            from django_harness.template_profiling import TemplateProfiler
+            template_profiler = TemplateProfiler()
+            profilers.append(template_profiler)
+
         from django.utils.translation import override
         with override(language):
-            path = reverse(view_name, args=url_args, kwargs=url_kwargs)
-            resolved = resolve(path)
+            if path is None:
+                path, resolved = resolver_cache.reverse_and_resolve(view_name,
+                    url_args, url_kwargs)
+            else:
+                resolved = resolver_cache.resolve_path(path)
 
             view = resolved.func
-            view.request = self.get_fake_request(path, method, get_params,
-                post_params, request_extras, file_params)
-            self.last_request = view.request
-            response = view(view.request, *resolved.args, **resolved.kwargs)
+            request = self.get_fake_request(path, method, get_params,
+                post_params, request_extras, file_params, request_template)
+            self.remember_request(view, request)
+
+            if middleware is None:
+                middleware = self.fast_dispatch_middleware
+
+            for profiler in profilers:
+                profiler.start()
+
+            try:
+                if middleware:
+                    request.resolver_match = resolved
+                    chain = get_middleware_chain(middleware)
+                    self.set_middleware_session(request)
+                    if language is not None and chain.uses_locale:
+                        set_request_language(request, language)
+                    response = chain.get_response(request, view,
+                        resolved.args, resolved.kwargs)
+                else:
+                    response = view(request, *resolved.args,
+                        **resolved.kwargs)
+
+                # make sure that we render while language override is in
+                # effect, and while profiling!
+                if ((render or language is not None or profilers) and
+                        hasattr(response, 'render')):
+                    response.render()
+            finally:
+                for profiler in reversed(profilers):
+                    profiler.stop()
+
+            # SessionMiddleware would save a real session if modified
+            if not middleware and getattr(request.session, 'modified', False):
+                request.session.save()
+
             response.view = view
+            response.request_path = request.get_full_path()
 
-            # make sure that we render while language override is in effect!
-            if language is not None and hasattr(response, 'render'):
-                response.render()
+        if profile_queries or max_queries is not None:
+            response.query_report = query_profiler.report()
 
-        return response
+            if (max_queries is not None and
+                    response.query_report.count > max_queries):
+                self.fail("%s ran %d queries, more than the budget of %d: %s"
+                    % (view_name or path, response.query_report.count,
+                        max_queries,
+                        response.query_report))
+
+        if profile_templates:
+            response.template_timings = template_profiler.timings
+
+        return response, request
+
+    def remember_request(self, view, request):
+        """
+        Makes the request available to tests as self.last_request and (for
+        compatibility) view.request, and its path as self.last_request_path.
+        In leak_free_dispatch mode, last_request is None, and we don't set
+        view.request, because either would keep the request alive until the
+        next dispatch (or for as long as the view function).
+        """
+
+        self.last_request_path = request.get_full_path()
+
+        if self.leak_free_dispatch:
+            self.last_request = None
+        else:
+            view.request = request
+            self.last_request = request
+
+    def fast_dispatch_many(self, specs):
+        """
+        Dispatch a batch of requests, sharing the RequestTemplate (which
+        holds the RequestFactory and the settings lookups) and the resolved
+        views between them.
+
+        Each spec is a dict of fast_dispatch() keyword arguments, such as
+        view_name, method, url_kwargs, get_params, post_params, language and
+        middleware, plus an optional user to attach to the request. Template
+        responses are rendered, so that the timings include rendering.
+
+        Returns a list of DispatchResult(response, request, elapsed) in the
+        same order as the specs, where elapsed is in seconds.
+        """
+
+        request_template = self.get_request_template()
+        return [self._dispatch_spec(spec, request_template) for spec in specs]
+
+    def fast_dispatch_concurrent(self, specs, max_workers=4):
+        """
+        Like fast_dispatch_many, but runs up to max_workers dispatches at
+        the same time in a pool of threads, which helps when the views spend
+        most of their time waiting for I/O, such as calls to stand-in HTTP
+        services. Each dispatch keeps its own language override and request,
+        and the results are returned in the same order as the specs.
+
+        Each thread uses its own database connection, which is closed after
+        each dispatch, so the views can't see uncommitted data from a
+        TestCase transaction: use a TransactionTestCase instead.
+        """
+
+        from multiprocessing.pool import ThreadPool
+        request_template = self.get_request_template()
+
+        def dispatch(spec):
+            try:
+                return self._dispatch_spec(spec, request_template)
+            finally:
+                from django.db import connections
+                for connection in connections.all():
+                    connection.close()
+
+        pool = ThreadPool(max_workers)
+        try:
+            results = pool.map(dispatch, specs)
+        finally:
+            pool.close()
+            pool.join()
+
+        if results:
+            self.remember_request(results[-1].response.view,
+                results[-1].request)
+
+        return results
+
+    def _dispatch_spec(self, spec, request_template):
+        spec = dict(spec)
+
+        if 'user' in spec:
+            request_extras = dict(spec.get('request_extras') or {})
+            request_extras['user'] = spec.pop('user')
+            spec['request_extras'] = request_extras
+
+        start = default_timer()
+        response, request = self._fast_dispatch(
+            request_template=request_template, render=True, **spec)
+        elapsed = default_timer() - start
+
+        return DispatchResult(response, request, elapsed)
+
+    def submit_form(self, response, form_selector='form', values=None,
+        **overrides):
+
+        """
+        Submits a form on a page, like a browser would: finds the form in
+        the (parsed) response with a CSS selector, collects the current
+        values of its fields with extract_form_values(), replaces them with
+        values and overrides (a value of None removes a field), and
+        dispatches the form's method and action with fast_dispatch. The
+        action is relative to the response's request_path (or the last
+        request's path, for responses that didn't come from fast_dispatch).
+
+        Needs HtmlParsingMixin as well.
+        """
+
+        from django.http import QueryDict
+
+        form = self.query(response, form_selector)
+        params = self.extract_form_values(form)
+
+        if values is not None:
+            overrides = dict(values, **overrides)
+
+        for name, value in overrides.iteritems():
+            if value is None:
+                params.pop(name, None)
+            else:
+                params[name] = value
+
+        action = form.get('action') or ''
+        base = getattr(response, 'request_path', None)
+        if base is None:
+            base = self.last_request_path
+
+        url = urlsplit(urljoin(base, action.strip()))
+
+        get_params = dict(QueryDict(url.query).lists())
+        method = (form.get('method') or 'get').lower()
+
+        if method == 'post':
+            return self.fast_dispatch(path=url.path, method='post',
+                get_params=get_params, post_params=params)
+        else:
+            # browsers replace the action's query string with the form data
+            return self.fast_dispatch(path=url.path, get_params=params)
+
+    def measure_memory_growth(self, view_name, repeat=5, **kwargs):
+        """
+        Dispatch the view once to warm up any legitimate caches, and then
+        repeat times more in leak_free_dispatch mode, throwing the responses
+        away, and return the memory retained per dispatch, which is also
+        recorded in memory_tracking.memory_growth_tracker. Start tracemalloc
+        (where available) to measure it in bytes instead of objects.
+        """
+
+        from django_harness.memory_tracking import memory_growth_tracker
+
+        leak_free_dispatch = self.leak_free_dispatch
+        self.leak_free_dispatch = True
+
+        try:
+            self.fast_dispatch(view_name, **kwargs)
+            before = memory_growth_tracker.measure()
+
+            for i in range(repeat):
+                self.fast_dispatch(view_name, **kwargs)
+
+            growth = float(memory_growth_tracker.measure() - before) / repeat
+        finally:
+            self.leak_free_dispatch = leak_free_dispatch
+
+        memory_growth_tracker.record(view_name, growth)
+        return growth
 
     def request_hook(self, request):
         pass
@@ -199,12 +778,14 @@ class FastDispatchMixin(object):
             if hasattr(response, 'render'):
                 response.render()
 
-            if isinstance(response.content, str):
-                content = unicode(response.content, 'utf-8')
-            else:
-                content = response.content
+            def get_content():
+                if isinstance(response.content, str):
+                    return unicode(response.content, 'utf-8')
+                else:
+                    return response.content
 
-            msg_prefix = content + u"\n\n" + unicode(msg_prefix)
+            # Only decode the content if the assertion fails
+            msg_prefix = LazyMessage(get_content) + u"\n\n" + msg_prefix
 
         self.assertEqual(response.status_code, status_code,
             msg_prefix + "Response didn't redirect as expected: Response"
@@ -242,18 +823,56 @@ class FastDispatchMixin(object):
         return response
 
     def stuff_session(self, dictionary):
+        """
+        Add the contents of dictionary to the session shared by the test
+        client and fast_dispatch, using the configured SESSION_ENGINE. Set
+        SESSION_ENGINE to 'django_harness.memory_session' to do this without
+        any database writes.
+
+        If the session isn't already logged in and the test has a user, we
+        log it in as that user directly, without checking the password.
+        """
+
         from django.conf import settings
-        if settings.SESSION_ENGINE != 'django.contrib.sessions.backends.db':
-            print "Unknown session engine: %s Sessions won't work" % settings.SESSION_ENGINE
-            return
-        self.client.logout()
-        from django.contrib.sessions.backends.db import SessionStore
-        store = SessionStore()
-        store.save()  # we need to make load() work, or the cookie is worthless
+        from django.contrib.auth import SESSION_KEY
+        from django.utils.importlib import import_module
+
+        engine = import_module(settings.SESSION_ENGINE)
+        cookie = self.client.cookies.get(settings.SESSION_COOKIE_NAME)
+
+        if cookie and cookie.value:
+            store = engine.SessionStore(cookie.value)
+        else:
+            store = engine.SessionStore()
+
+        if SESSION_KEY not in store and getattr(self, 'user', None):
+            self.stuff_session_login(store, self.user)
+
+        store.update(dictionary)
+        store.save()
+
         self.client.cookies[settings.SESSION_COOKIE_NAME] = store.session_key
-        self.client.session.update(dictionary)
-        self.client.session.save()
-        self.client.login(username=self.user.username, password=self.password)
+        self.stuffed_session_key = store.session_key
+
+    def stuff_session_login(self, store, user):
+        """
+        Does what django.contrib.auth.login() would do to the session,
+        without needing a request or the user's password.
+        """
+
+        from django.conf import settings
+        from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY
+
+        store[SESSION_KEY] = user.pk
+        store[BACKEND_SESSION_KEY] = getattr(user, 'backend',
+            settings.AUTHENTICATION_BACKENDS[0])
+
+        try:
+            # Django 1.7 and above check this too
+            from django.contrib.auth import HASH_SESSION_KEY
+            store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        except ImportError:
+            pass
 
     def assertInDict(self, member, container, msg=None):
         """
@@ -282,17 +901,41 @@ class FastDispatchMixin(object):
         if hasattr(response, 'render'):
             response.render()
 
-        from django.utils.encoding import force_text
-        content = force_text(response.content)
-        msg_prefix = content + "\n\n" + msg_prefix
-
         try:
-            super(FastDispatchMixin, self).assertContains(response, text,
-                count, status_code, msg_prefix, html)
+            # html_compare_engine is defined by HtmlParsingMixin
+            if html and getattr(self, 'html_compare_engine', None) == 'lxml':
+                self.assert_contains_html(response, text, count, status_code,
+                    msg_prefix)
+            else:
+                super(FastDispatchMixin, self).assertContains(response, text,
+                    count, status_code, msg_prefix, html)
         except AssertionError as e:
+            # Only decode the content if the assertion fails
             import sys
-            raise sys.exc_info()[0], "%s\n\nThe complete response was:\n%s" % \
-                (e, content), sys.exc_info()[2]
+            exc_info = sys.exc_info()
+            from django.utils.encoding import force_text
+            raise exc_info[0], "%s\n\nThe complete response was:\n%s" % \
+                (e, force_text(response.content)), exc_info[2]
+
+    def assert_contains_html(self, response, text, count, status_code,
+        msg_prefix):
+
+        from django.utils.encoding import force_text
+        from django_harness import html_compare
+
+        self.assertEqual(response.status_code, status_code,
+            msg_prefix + "Couldn't retrieve content: Response code was %d"
+            " (expected %d)" % (response.status_code, status_code))
+
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+
+        text = force_text(text, encoding=response._charset)
+        content = content.decode(response._charset)
+        html_compare.assert_count(self, text, content, count, msg_prefix,
+            "'%s'" % text)
 
     def absolute_url_for_site(self, relative_url):
         """
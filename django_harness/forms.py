@@ -1,6 +1,11 @@
 from __future__ import absolute_import, unicode_literals
 
+import collections
 import datetime
+import itertools
+import random
+import string
+import weakref
 
 from django.core.files.base import ContentFile
 from django.db.models import Model
@@ -15,6 +20,672 @@ except ImportError as e:
         pass
 
 
+class ChoiceIndex(object):
+    """
+    The choices of a widget (or field), evaluated once, and their possible
+    values (from get_possible_values) in a set, so that checking whether a
+    value is one of them doesn't have to search a list, except for any
+    values that aren't hashable.
+    """
+
+    def __init__(self, choices, possible_values):
+        self.choices = choices
+        self.values = possible_values
+        self.hashable = set()
+        self.unhashable = []
+
+        for value in possible_values:
+            try:
+                self.hashable.add(value)
+            except TypeError:
+                self.unhashable.append(value)
+
+    def __contains__(self, value):
+        try:
+            if value in self.hashable:
+                return True
+        except TypeError:
+            pass
+
+        return any(value == other for other in self.unhashable)
+
+# widget or field => (choices, ChoiceIndex), for as long as the widget
+# (which belongs to a single form instance) exists
+choice_indexes = weakref.WeakKeyDictionary()
+
+def get_choice_index(test, owner):
+    """
+    Returns a ChoiceIndex for owner.choices, reusing the last one until
+    the choices are replaced, so that a ModelChoiceField's queryset is only
+    run once per form instance.
+    """
+
+    choices = owner.choices
+    cached = choice_indexes.get(owner)
+    if cached is not None and cached[0] is choices:
+        return cached[1]
+
+    # not list(choices), which would call ModelChoiceIterator.__len__,
+    # which runs the query an extra time
+    evaluated = [choice for choice in choices]
+    index = ChoiceIndex(evaluated, test.get_possible_values(evaluated))
+    choice_indexes[owner] = (choices, index)
+    return index
+
+def convert_file_input(test, widget, name, value, strict):
+    # this is a special case: don't convert FieldFile objects to strings,
+    # because the TestClient needs to detect and encode them properly.
+    if bool(value):
+        return {name: value}
+    else:
+        # empty file upload, don't set any parameters
+        return {}
+
+def convert_multi_widget(test, widget, name, value, strict):
+    values = {}
+    for index, subwidget in enumerate(widget.widgets):
+        param_name = "%s_%s" % (name, index)
+        values.update(test.value_to_datadict(subwidget, param_name,
+            value, strict))
+    return values
+
+def convert_checkbox_input(test, widget, name, value, strict):
+    if widget.check_test(value):
+        return {name: '1'}
+    else:
+        # unchecked checkboxes are not sent in HTML
+        return {}
+
+def convert_select(test, widget, name, value, strict):
+    if '__iter__' in dir(value):
+        values = list(value)
+    else:
+        values = [value]
+
+    index = get_choice_index(test, widget)
+    choices = index.choices
+    possible_values = index.values
+    found_values = []
+
+    for v in values:
+        if v in index:
+            found_values.append(str(v))
+        elif v == '' and isinstance(widget, django.forms.widgets.RadioSelect):
+            # It's possible not to select any option in a RadioSelect
+            # widget, although this will probably generate an error
+            # as the field is probably required, but we need to be
+            # able to test that behaviour, by passing an empty string.
+            #
+            # In that case, we don't add anything to the POST data,
+            # because a user agent wouldn't either if the user hasn't
+            # selected any of the radio buttons
+            pass
+        elif strict:
+            # Since user agent behaviour differs, authors should ensure
+            # that each menu includes a default pre-selected OPTION
+            # (i.e. that a list includes a selected value)
+            raise Exception("List without selected value: "
+                "%s = %s (should be one of: %s)" %
+                (name, value, [label for label, value in choices]))
+        else:
+            # don't add anything to the list right now
+            pass
+
+    if found_values:
+        if len(found_values) == 1:
+            # If there's just a single value, return the plain value
+            return {name: found_values[0]}
+        else:
+            # Otherwise we have no choice but to return an array
+            return {name: found_values}
+    elif isinstance(widget, django.forms.widgets.RadioSelect):
+        # As above, it's possible not to select any option in a
+        # RadioSelect widget. In that case, we don't add anything
+        # to the POST data.
+        return {}
+    elif len(possible_values) == 0:
+        # it's possible to select no option in a drop-down list with
+        # no options!
+        return {}
+    else:
+        # most browsers pre-select the first value
+        return {name: str(possible_values[0])}
+
+def convert_related_field_widget_wrapper(test, widget, name, value, strict):
+    subwidget = widget.widget
+    index = get_choice_index(test, widget)
+    subwidget.choices = index.choices
+    choice_indexes[subwidget] = (index.choices, index)
+    return test.value_to_datadict(subwidget, name, value, strict)
+
+def convert_nothing(test, widget, name, value, strict):
+    return {}
+
+def convert_textarea(test, widget, name, value, strict):
+    from django.utils.encoding import force_unicode
+    if value is None:
+        value = ''
+    return {name: force_unicode(value)}
+
+def convert_formatted_value(test, widget, name, value, strict):
+    """
+    The fallback for widgets with no registered converter.
+    """
+
+    from django.utils.encoding import force_unicode
+
+    if getattr(widget, '_format_value', None):
+        if value is None:
+            value = ''
+        else:
+            value = widget._format_value(value)
+        return {name: force_unicode(value)}
+
+    else:
+        raise Exception("Don't know how to convert data to form values " +
+            "for %s" % widget)
+
+# widget class => converter(test, widget, name, value, strict), which
+# returns a dictionary of POST parameters
+widget_converters = {}
+# widget class => the converter of the nearest class in its MRO
+resolved_widget_converters = {}
+default_widget_converters_registered = False
+
+def register_widget_converter(widget_class, converter):
+    """
+    Tells FormUtilsMixin.value_to_datadict how to convert values for
+    widget_class and its subclasses (unless they have their own converter).
+    """
+
+    widget_converters[widget_class] = converter
+    resolved_widget_converters.clear()
+    form_plans.clear()
+
+def register_default_widget_converters():
+    """
+    Registers converters for Django's own widgets, which we only import
+    when they're first needed, as the admin and auth modules need settings.
+    """
+
+    global default_widget_converters_registered
+    if default_widget_converters_registered:
+        return
+    default_widget_converters_registered = True
+
+    import django.contrib.admin.widgets
+    import django.contrib.auth.forms
+
+    widgets = django.forms.widgets
+    for widget_class, converter in [
+        (widgets.FileInput, convert_file_input),
+        (widgets.MultiWidget, convert_multi_widget),
+        (widgets.CheckboxInput, convert_checkbox_input),
+        (widgets.Select, convert_select),
+        (django.contrib.admin.widgets.RelatedFieldWidgetWrapper,
+            convert_related_field_widget_wrapper),
+        (django.contrib.auth.forms.ReadOnlyPasswordHashWidget,
+            convert_nothing),
+        (widgets.Textarea, convert_textarea),
+    ]:
+        # don't replace converters that a project registered already
+        widget_converters.setdefault(widget_class, converter)
+
+    resolved_widget_converters.clear()
+    form_plans.clear()
+
+def get_widget_converter(widget_class):
+    try:
+        return resolved_widget_converters[widget_class]
+    except KeyError:
+        pass
+
+    register_default_widget_converters()
+
+    for cls in widget_class.__mro__:
+        converter = widget_converters.get(cls)
+        if converter is not None:
+            break
+    else:
+        converter = convert_formatted_value
+
+    resolved_widget_converters[widget_class] = converter
+    return converter
+
+
+FieldPlan = collections.namedtuple("FieldPlan",
+    ["name", "param_name", "converter"])
+
+class FormPlan(object):
+    """
+    The parameter name and widget converter of each field in a form, in
+    order, worked out once for each combination of form class, prefix and
+    fields (which forms can change per instance), so that
+    update_form_values only has to convert the values.
+    """
+
+    def __init__(self, form):
+        self.fields = []
+        self.field_names = []
+
+        for name, field in form.fields.iteritems():
+            if form.prefix:
+                param_name = "%s-%s" % (form.prefix, name)
+            else:
+                param_name = name
+
+            self.fields.append(FieldPlan(name, param_name,
+                get_widget_converter(field.widget.__class__)))
+            self.field_names.append(name)
+
+        self.field_name_set = set(self.field_names)
+
+# (form class, prefix, field names and widget classes) => FormPlan
+form_plans = {}
+
+def get_form_plan(form):
+    key = (form.__class__, form.prefix, tuple((name, field.widget.__class__)
+        for name, field in form.fields.iteritems()))
+
+    plan = form_plans.get(key)
+    if plan is None:
+        plan = form_plans[key] = FormPlan(form)
+
+    return plan
+
+def make_query_dict(post_data):
+    query_dict = QueryDict('', mutable=True).copy()
+    for key, value in post_data.iteritems():
+        if hasattr(value, '__iter__'):
+            query_dict.setlist(key, value)
+        else:
+            query_dict.setlist(key, [value])
+    query_dict._mutable = False
+    return query_dict
+
+
+class OutOfUniqueValues(Exception):
+    pass
+
+class UnsupportedField(Exception):
+    pass
+
+def fit_text(text, suffix, max_length):
+    """
+    Appends suffix to text, truncating text so that the result is no
+    longer than max_length (if not None), so that the suffix (which makes
+    it unique) is kept.
+    """
+
+    if max_length is not None and len(suffix) > max_length:
+        raise OutOfUniqueValues("%r doesn't fit in %d characters" %
+            (suffix, max_length))
+    if max_length is not None and len(text) + len(suffix) > max_length:
+        text = text[:max_length - len(suffix)]
+    return text + suffix
+
+def random_word(rng, length=8):
+    return ''.join(rng.choice(string.ascii_lowercase) for i in range(length))
+
+# dates are counted from here, not today, so that payloads don't depend on
+# the day that they are generated
+DUMMY_BASE_DATE = datetime.date(2000, 1, 1)
+
+# the smallest valid GIF image, for ImageFields
+DUMMY_GIF = (b'GIF89a\x01\x00\x01\x00\x00\x00\x00!\xf9\x04\x01\x00\x00'
+    b'\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x01D\x00;')
+
+def has_choices(field):
+    return (hasattr(field, 'choices') or
+        isinstance(field.widget, django.forms.widgets.Select))
+
+def get_dummy_choices(test, field):
+    """
+    The values that can be chosen for field, as strings, without any blank
+    value, which is usually not a valid choice.
+    """
+
+    if hasattr(field.widget, 'choices'):
+        choice_index = get_choice_index(test, field.widget)
+    else:
+        choice_index = get_choice_index(test, field)
+
+    return [str(value) for value in choice_index.values if value != '']
+
+def is_valid_value(field, value):
+    from django.core.exceptions import ValidationError
+
+    try:
+        field.clean(value)
+        return True
+    except ValidationError:
+        return False
+
+def text_value_generator(field, name, unique):
+    """
+    Returns a generator for a CharField (or RegexField), in the first style
+    (words, a slug or digits) that the field accepts.
+    """
+
+    max_length = getattr(field, 'max_length', None)
+    length = max(8, getattr(field, 'min_length', None) or 0)
+
+    def words(index, rng):
+        suffix = " %d" % index if unique else ""
+        return fit_text("Whee " + random_word(rng, length), suffix,
+            max_length)
+
+    def slug(index, rng):
+        suffix = "-%d" % index if unique else ""
+        return fit_text("whee-" + random_word(rng, length), suffix,
+            max_length)
+
+    def digits(index, rng):
+        suffix = "%d" % index if unique else ""
+        return fit_text("".join(rng.choice(string.digits)
+            for i in range(length)), suffix, max_length)
+
+    if isinstance(field, django.forms.fields.SlugField):
+        return slug
+
+    for generate in (words, slug, digits):
+        try:
+            sample = generate(0, random.Random(0))
+        except OutOfUniqueValues:
+            # the number doesn't fit with a separator, but might without
+            continue
+        if is_valid_value(field, sample):
+            return generate
+
+    raise UnsupportedField("Can't generate valid values for field %s (%s): "
+        "pass its value in post_data" % (name, field.__class__.__name__))
+
+def ip_address_generator(field, unique):
+    # a GenericIPAddressField may only accept IPv6
+    if is_valid_value(field, '10.0.0.1'):
+        def generate(index, rng):
+            if not unique:
+                index = rng.randint(0, 2 ** 24 - 1)
+            elif index >= 2 ** 24:
+                raise OutOfUniqueValues("Ran out of unique IP addresses")
+            return "10.%d.%d.%d" % (index >> 16, (index >> 8) & 255,
+                index & 255)
+    else:
+        def generate(index, rng):
+            if not unique:
+                index = rng.randint(0, 2 ** 32 - 1)
+            return "2001:db8::%x:%x" % ((index >> 16) & 0xffff,
+                index & 0xffff)
+
+    return generate
+
+def make_value_generator(test, field, name, unique):
+    import django.forms.fields
+    widget = field.widget
+
+    if isinstance(widget, ReCaptcha):
+        return lambda index, rng: None
+
+    if has_choices(field):
+        values = get_dummy_choices(test, field)
+        if not values:
+            return lambda index, rng: None
+
+        multiple = isinstance(widget, django.forms.widgets.SelectMultiple)
+
+        if unique:
+            stride, combinations = unique
+            if combinations is None:
+                combinations = len(values)
+
+            def generate(index, rng):
+                if index >= combinations:
+                    raise OutOfUniqueValues("Ran out of unique choices for "
+                        "field %s after %d payloads" % (name, combinations))
+                value = values[(index // stride) % len(values)]
+                return [value] if multiple else value
+        elif multiple:
+            def generate(index, rng):
+                return rng.sample(values, rng.randint(1, min(3, len(values))))
+        else:
+            def generate(index, rng):
+                return rng.choice(values)
+
+        return generate
+
+    if isinstance(field, django.forms.fields.MultiValueField):
+        # e.g. SplitDateTimeField: a list of values for its fields, only
+        # the first of which needs to be unique
+        generators = [make_value_generator(test, subfield,
+                "%s_%d" % (name, i), unique if i == 0 else None)
+            for i, subfield in enumerate(field.fields)]
+
+        def generate(index, rng):
+            values = [generate_one(index, rng)
+                for generate_one in generators]
+            return ['' if value is None else value for value in values]
+        return generate
+
+    if isinstance(field, django.forms.fields.BooleanField):
+        if field.required:
+            return lambda index, rng: 'on'
+        return lambda index, rng: 'on' if rng.random() < 0.5 else None
+
+    if isinstance(field, django.forms.fields.ImageField):
+        def generate(index, rng):
+            value = ContentFile(DUMMY_GIF)
+            value.name = "whee-%d.gif" % index
+            return value
+        return generate
+
+    if isinstance(field, django.forms.fields.FileField):
+        def generate(index, rng):
+            value = ContentFile("Whee %d %s" % (index, random_word(rng)))
+            value.name = "whee-%d.txt" % index
+            return value
+        return generate
+
+    if isinstance(field, django.forms.fields.EmailField):
+        def generate(index, rng):
+            suffix = "%d@example.com" % index if unique else "@example.com"
+            return fit_text(random_word(rng), suffix, field.max_length)
+        return generate
+
+    if isinstance(field, django.forms.fields.URLField):
+        def generate(index, rng):
+            suffix = "/%d/" % index if unique else "/"
+            return fit_text("http://example.com/" + random_word(rng), suffix,
+                field.max_length)
+        return generate
+
+    if isinstance(field, (django.forms.fields.IPAddressField,
+            django.forms.fields.GenericIPAddressField)):
+        return ip_address_generator(field, unique)
+
+    if isinstance(field, (django.forms.fields.DateField,
+            django.forms.fields.DateTimeField)):
+
+        split = isinstance(widget, django.forms.widgets.MultiWidget)
+
+        def generate(index, rng):
+            if unique:
+                days = index
+            else:
+                days = rng.randint(0, 3650)
+            value = DUMMY_BASE_DATE + datetime.timedelta(days=days)
+
+            if isinstance(field, django.forms.fields.DateTimeField):
+                time = "%02d:%02d:00" % (rng.randint(0, 23),
+                    rng.randint(0, 59))
+                return [str(value), time] if split else \
+                    "%s %s" % (value, time)
+            return str(value)
+        return generate
+
+    if isinstance(field, django.forms.fields.TimeField):
+        def generate(index, rng):
+            if not unique:
+                index = rng.randint(0, 24 * 60 * 60 - 1)
+            elif index >= 24 * 60 * 60:
+                raise OutOfUniqueValues("Field %s only has %d times" %
+                    (name, 24 * 60 * 60))
+            return "%02d:%02d:%02d" % (index // 3600, index // 60 % 60,
+                index % 60)
+        return generate
+
+    if isinstance(field, django.forms.fields.IntegerField):
+        # also FloatField and DecimalField, which are subclasses
+        low = field.min_value if field.min_value is not None else 0
+        high = field.max_value if field.max_value is not None else 10 ** 6
+
+        max_digits = getattr(field, 'max_digits', None)
+        if max_digits is not None:
+            places = getattr(field, 'decimal_places', None) or 0
+            high = min(high, 10 ** (max_digits - places) - 1)
+
+        def generate(index, rng):
+            if not unique:
+                return str(rng.randint(int(low), int(high)))
+            if low + index > high:
+                raise OutOfUniqueValues("Field %s only has %d values" %
+                    (name, high - low + 1))
+            return str(int(low) + index)
+        return generate
+
+    if isinstance(field, django.forms.fields.CharField):
+        return text_value_generator(field, name, unique)
+
+    if field.required:
+        return lambda index, rng: "Whee %d" % index if unique else "Whee"
+
+    return lambda index, rng: None
+
+def dummy_value_generator(test, field, name, unique=None):
+    """
+    Returns a function(index, rng) that generates a value for field (named
+    name) in the index'th payload, using rng (a random.Random) for anything
+    that doesn't have to be unique, or None to leave it out of the payload.
+
+    Values of unique fields are derived from the index, so that they are
+    distinct however many payloads there are. unique is None, or a
+    (stride, combinations) tuple from get_unique_fields, which says how to
+    count through the choices of a choice field.
+
+    Raises UnsupportedField if the field doesn't accept the values that we
+    can generate for it.
+    """
+
+    generate = make_value_generator(test, field, name, unique)
+
+    # choices are valid by definition, and files aren't worth checking
+    if not has_choices(field) and \
+            not isinstance(field, django.forms.fields.FileField):
+        sample = generate(0, random.Random(0))
+        if sample is not None and not is_valid_value(field, sample):
+            raise UnsupportedField("Can't generate valid values for field "
+                "%s (%s), such as %r: pass its value in post_data" %
+                (name, field.__class__.__name__, sample))
+
+    return generate
+
+def add_dummy_value(params, field, param_name, value):
+    """
+    Adds a generated value to params, unless it's None, split into one
+    parameter per subwidget for a MultiWidget (e.g. SplitDateTimeWidget).
+    """
+
+    if value is None:
+        return
+
+    if isinstance(field.widget, django.forms.widgets.MultiWidget) and \
+            isinstance(value, list):
+        for i, subvalue in enumerate(value):
+            params["%s_%d" % (param_name, i)] = subvalue
+    else:
+        params[param_name] = value
+
+def get_numbering_rank(field):
+    """
+    How well field can hold the number of each payload, to make them
+    distinct when nothing else has to be unique: lower is better, and None
+    if it can't.
+    """
+
+    if has_choices(field) or isinstance(field.widget, HiddenInput) or \
+            isinstance(field, (django.forms.fields.BooleanField,
+                django.forms.fields.FileField,
+                django.forms.fields.MultiValueField)):
+        return None
+    elif isinstance(field, django.forms.fields.CharField):
+        return 0
+    elif isinstance(field, (django.forms.fields.DateField,
+            django.forms.fields.DateTimeField)):
+        return 1
+    elif isinstance(field, django.forms.fields.IntegerField):
+        return 2
+    return None
+
+def get_unique_fields(test, form):
+    """
+    Returns a dictionary of the names of the fields of a ModelForm which
+    must have unique values, or be unique together with other fields, each
+    mapped to a (stride, combinations) tuple: the stride that its choices
+    (if any) should be counted in, and the number of distinct payloads that
+    can be made, or None if that's simply the number of choices.
+
+    For each unique_together constraint, it's enough for one of its fields
+    to be unique on its own, if it has values that we can count; otherwise
+    they are all choice fields, whose choices are combined. Hidden fields
+    (such as the foreign key of an inline formset) keep their initial
+    values, so the other fields have to be unique instead.
+    """
+
+    from django.db.models.fields import FieldDoesNotExist
+
+    model = getattr(getattr(form, '_meta', None), 'model', None)
+    if model is None:
+        return {}
+
+    def is_hidden(name):
+        return isinstance(form.fields[name].widget, HiddenInput)
+
+    unique = {}
+    for name in form.fields:
+        if is_hidden(name):
+            continue
+        try:
+            model_field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if model_field.unique and not model_field.primary_key:
+            unique[name] = (1, None)
+
+    for together in model._meta.unique_together:
+        if not all(name in form.fields for name in together):
+            # can't be violated by this form alone
+            continue
+        if any(name in unique for name in together):
+            continue
+
+        variable = [name for name in together if not is_hidden(name)]
+        counted = [name for name in variable
+            if not has_choices(form.fields[name])]
+        if counted:
+            unique[counted[0]] = (1, None)
+            continue
+
+        strides = []
+        combinations = 1
+        for name in variable:
+            strides.append((name, combinations))
+            combinations *= len(get_dummy_choices(test, form.fields[name]))
+
+        for name, stride in strides:
+            unique[name] = (stride, combinations)
+
+    return unique
+
+
 class FormUtilsMixin(object):
     def get_possible_values(self, choices):
         possible_values = []
@@ -43,115 +714,12 @@ class FormUtilsMixin(object):
         suitable for passing to client.post().
 
         This needs to be implemented for each subclass of Widget that doesn't
-        just convert its value to a string.
+        just convert its value to a string, by registering a converter with
+        register_widget_converter().
         """
 
-        import django.forms.widgets
-        import django.contrib.admin.widgets
-        import django.contrib.auth.forms
-        from django.utils.encoding import force_unicode
-
-        if isinstance(widget, django.forms.widgets.FileInput):
-            # this is a special case: don't convert FieldFile objects to strings,
-            # because the TestClient needs to detect and encode them properly.
-            if bool(value):
-                return {name: value}
-            else:
-                # empty file upload, don't set any parameters
-                return {}
-
-        elif isinstance(widget, django.forms.widgets.MultiWidget):
-            values = {}
-            for index, subwidget in enumerate(widget.widgets):
-                param_name = "%s_%s" % (name, index)
-                values.update(self.value_to_datadict(subwidget, param_name,
-                    value, strict))
-            return values
-
-        elif isinstance(widget, django.forms.widgets.CheckboxInput):
-            if widget.check_test(value):
-                return {name: '1'}
-            else:
-                # unchecked checkboxes are not sent in HTML
-                return {}
-
-        elif isinstance(widget, django.forms.widgets.Select):
-            if '__iter__' in dir(value):
-                values = list(value)
-            else:
-                values = [value]
-
-            choices = list(widget.choices)
-            possible_values = self.get_possible_values(choices)
-            found_values = []
-
-            for v in values:
-                if v in possible_values:
-                    found_values.append(str(v))
-                elif v == '' and isinstance(widget, django.forms.widgets.RadioSelect):
-                    # It's possible not to select any option in a RadioSelect
-                    # widget, although this will probably generate an error
-                    # as the field is probably required, but we need to be
-                    # able to test that behaviour, by passing an empty string.
-                    #
-                    # In that case, we don't add anything to the POST data,
-                    # because a user agent wouldn't either if the user hasn't
-                    # selected any of the radio buttons
-                    pass
-                elif strict:
-                    # Since user agent behaviour differs, authors should ensure
-                    # that each menu includes a default pre-selected OPTION
-                    # (i.e. that a list includes a selected value)
-                    raise Exception("List without selected value: "
-                        "%s = %s (should be one of: %s)" %
-                        (name, value, [label for label, value in choices]))
-                else:
-                    # don't add anything to the list right now
-                    pass
-
-            if found_values:
-                if len(found_values) == 1:
-                    # If there's just a single value, return the plain value
-                    return {name: found_values[0]}
-                else:
-                    # Otherwise we have no choice but to return an array
-                    return {name: found_values}
-            elif isinstance(widget, django.forms.widgets.RadioSelect):
-                # As above, it's possible not to select any option in a
-                # RadioSelect widget. In that case, we don't add anything
-                # to the POST data.
-                return {}
-            elif len(possible_values) == 0:
-                # it's possible to select no option in a drop-down list with
-                # no options!
-                return {}
-            else:
-                # most browsers pre-select the first value
-                return {name: str(possible_values[0])}
-
-        elif isinstance(widget, django.contrib.admin.widgets.RelatedFieldWidgetWrapper):
-            subwidget = widget.widget
-            subwidget.choices = list(widget.choices)
-            return self.value_to_datadict(subwidget, name, value, strict)
-
-        elif isinstance(widget, django.contrib.auth.forms.ReadOnlyPasswordHashWidget):
-            return {}
-
-        elif isinstance(widget, django.forms.widgets.Textarea):
-            if value is None:
-                value = ''
-            return {name: force_unicode(value)}
-
-        elif getattr(widget, '_format_value', None):
-            if value is None:
-                value = ''
-            else:
-                value = widget._format_value(value)
-            return {name: force_unicode(value)}
-
-        else:
-            raise Exception("Don't know how to convert data to form values " +
-                "for %s" % widget)
+        converter = get_widget_converter(widget.__class__)
+        return converter(self, widget, name, value, strict)
 
     def update_form_values(self, form, **new_values):
         """
@@ -162,32 +730,39 @@ class FormUtilsMixin(object):
         """
 
         params = dict()
+        plan = get_form_plan(form)
 
-        field_names = [bound_field.name for bound_field in form]
         for name in new_values:
-            if name not in field_names:
+            if name not in plan.field_name_set:
                 self.fail("Tried to change value for unknown field %s. Valid "
-                    "field names are: %s" % (name, field_names))
+                    "field names are: %s" % (name, plan.field_names))
 
-        from django.forms.widgets import MultiWidget
-        for bound_field in form:
-            # fields[k] returns a BoundField, not a django.forms.fields.Field
-            # which is where the widget lives
-            form_field = bound_field.field
-            widget = form_field.widget
+        # Call the converters directly, unless a subclass has overridden
+        # value_to_datadict.
+        use_converters = (self.value_to_datadict.__func__ is
+            FormUtilsMixin.value_to_datadict.__func__)
+
+        for field_plan in plan.fields:
+            # form.fields holds the django.forms.fields.Field, which is
+            # where the widget lives
+            widget = form.fields[field_plan.name].widget
 
             # defaults to the current value bound into the form:
-            value = new_values.get(bound_field.name, bound_field.value())
+            if field_plan.name in new_values:
+                value = new_values[field_plan.name]
+            else:
+                value = form[field_plan.name].value()
 
             # be strict with values passed by tests to this function,
             # and lax with values that were already in the record/form
-            if form.prefix:
-                param_name = "%s-%s" % (form.prefix, bound_field.name)
-            else:
-                param_name = bound_field.name
+            strict = (field_plan.name in new_values)
 
-            new_params = self.value_to_datadict(widget, param_name, value,
-                strict=(bound_field.name in new_values))
+            if use_converters:
+                new_params = field_plan.converter(self, widget,
+                    field_plan.param_name, value, strict)
+            else:
+                new_params = self.value_to_datadict(widget,
+                    field_plan.param_name, value, strict)
 
             params.update(new_params)
 
@@ -216,12 +791,14 @@ class FormUtilsMixin(object):
         if (hasattr(bound_field.field, 'choices') or
                 isinstance(widget, django.forms.widgets.Select)):
 
-            choices = (
-                getattr(bound_field.field, 'choices', None) or
-                list(widget.choices)
-            )
+            # A ModelChoiceField returns a new iterator every time we ask
+            # for its choices, but they're the same as its widget's.
+            if hasattr(widget, 'choices'):
+                index = get_choice_index(self, widget)
+            else:
+                index = get_choice_index(self, bound_field.field)
 
-            possible_values = self.get_possible_values(choices)
+            possible_values = index.values
 
             # Skip any blank first item, as it's usually not a valid choice.
             if possible_values[0] == '' and len(possible_values) >= 2:
@@ -277,13 +854,7 @@ class FormUtilsMixin(object):
                 post_data.update(self.generate_dummy_data(form, bound_field,
                     param_name, fields_to_delete))
 
-        query_dict = QueryDict('', mutable=True).copy()
-        for key, value in post_data.iteritems():
-            if hasattr(value, '__iter__'):
-                query_dict.setlist(key, value)
-            else:
-                query_dict.setlist(key, [value])
-        query_dict._mutable = False
+        query_dict = make_query_dict(post_data)
 
         if create_new_form:
             new_form = form.__class__(query_dict)
@@ -302,3 +873,176 @@ class FormUtilsMixin(object):
             return new_form, post_data
         else:
             return post_data
+
+    def fill_formset_with_dummy_data(self, formset, n_forms=None,
+            post_data=None, create_new_formset=True, seed=0, start=0):
+        """
+        Generates POST data for n_forms child forms of formset (by default,
+        as many as it has), as fill_form_with_dummy_data does for a single
+        form, with the management form filled in from the formset, so that
+        there's no need to GET and parse the page that renders it.
+
+        The dummy value of each field is only generated once, and copied to
+        every child form, except for hidden fields (such as the primary key
+        and inline foreign key of a model formset) and file uploads, which
+        are generated for each form, and unique (or unique_together) fields
+        of a model formset, whose values are numbered by the form's index
+        (counting from start), as in iter_dummy_payloads(). Use a different
+        start (or seed) to fill the formset again when the database already
+        contains objects saved from an earlier one.
+        """
+
+        from django.forms.formsets import TOTAL_FORM_COUNT
+        from django.forms.models import BaseInlineFormSet, BaseModelFormSet
+
+        if post_data is None:
+            post_data = {}
+        else:
+            post_data = dict(post_data)
+
+        if n_forms is None:
+            n_forms = formset.total_form_count()
+
+        management_form = formset.management_form
+        for bound_field in management_form:
+            param_name = management_form.add_prefix(bound_field.name)
+            if param_name not in post_data:
+                value = bound_field.value()
+                post_data[param_name] = '' if value is None else str(value)
+        post_data[management_form.add_prefix(TOTAL_FORM_COUNT)] = str(n_forms)
+
+        # Generate the values that are the same for every child form from
+        # the formset's empty form, whose fields are the same as theirs,
+        # except for unique fields, whose values are numbered by form.
+        template = formset.empty_form
+        unique = get_unique_fields(self, template)
+        shared_values = collections.OrderedDict()
+        unique_generators = []
+        per_form_fields = []
+        fields_to_delete = []
+        rng = random.Random(seed)
+
+        for bound_field in template:
+            field = bound_field.field
+            if (isinstance(field.widget, HiddenInput) or
+                    isinstance(field, django.forms.fields.FileField)):
+                per_form_fields.append(bound_field.name)
+            elif bound_field.name in unique:
+                unique_generators.append((bound_field.name, field,
+                    dummy_value_generator(self, field, bound_field.name,
+                        unique[bound_field.name])))
+            else:
+                shared_values[bound_field.name] = self.generate_dummy_data(
+                    template, bound_field, bound_field.name,
+                    fields_to_delete)
+
+        for i in range(n_forms):
+            prefix = formset.add_prefix(i)
+
+            for name, data in shared_values.iteritems():
+                param_name = "%s-%s" % (prefix, name)
+                if data and param_name not in post_data:
+                    post_data[param_name] = data[name]
+
+            for name, field, generate in unique_generators:
+                param_name = "%s-%s" % (prefix, name)
+                if param_name not in post_data:
+                    add_dummy_value(post_data, field, param_name,
+                        generate(start + i, rng))
+
+            if per_form_fields:
+                # Only construct the child forms that have values of
+                # their own, such as the instance that each one edits.
+                form = formset._construct_form(i)
+                for name in per_form_fields:
+                    param_name = form.add_prefix(name)
+                    if param_name not in post_data:
+                        post_data.update(self.generate_dummy_data(form,
+                            form[name], param_name, fields_to_delete))
+
+        query_dict = make_query_dict(post_data)
+
+        if create_new_formset:
+            kwargs = {'prefix': formset.prefix}
+            if isinstance(formset, BaseInlineFormSet):
+                kwargs['instance'] = formset.instance
+            elif (isinstance(formset, BaseModelFormSet) and
+                    formset.queryset is not None):
+                kwargs['queryset'] = formset.queryset
+
+            new_formset = formset.__class__(query_dict, **kwargs)
+
+            for form in new_formset.forms:
+                for field_name in set(fields_to_delete):
+                    del form.fields[field_name]
+
+            return new_formset, post_data
+        else:
+            return post_data
+
+    def iter_dummy_payloads(self, form_class, count=None, seed=0, start=0,
+            post_data=None, prefix=None):
+        """
+        Generates count (by default, endless) distinct POST payloads for
+        form_class, like those of fill_form_with_dummy_data but with
+        pseudo-random values, which are the same every time for the same
+        seed. Optional fields are filled in too, where we know how.
+
+        The fields of a ModelForm that are unique, or unique_together, get
+        values derived from the payload's number (counting from start), so
+        that the payloads can all be saved. Use a different start to add
+        more to a database that already contains some. If there are none,
+        one text, date or number field is numbered anyway, so that the
+        payloads are always distinct. Raises UnsupportedField for fields
+        that we can't generate valid values for, which can be given in
+        post_data instead.
+
+        Payloads are generated one at a time, so that a large number of
+        them can be posted or saved without holding them all in memory.
+        """
+
+        rng = random.Random(seed)
+        template = form_class(prefix=prefix)
+        unique = get_unique_fields(self, template)
+
+        bound_fields = [bound_field for bound_field in template
+            if post_data is None or
+                template.add_prefix(bound_field.name) not in post_data]
+
+        if not any(bound_field.name in unique
+                for bound_field in bound_fields):
+            ranked = [(get_numbering_rank(bound_field.field), i, bound_field)
+                for i, bound_field in enumerate(bound_fields)]
+            ranked = [entry for entry in ranked if entry[0] is not None]
+            if ranked:
+                unique[min(ranked)[2].name] = (1, None)
+
+        # fixed values (hidden fields), and (param_name, field, generator)
+        fixed = {}
+        generators = []
+        for bound_field in bound_fields:
+            field = bound_field.field
+            param_name = template.add_prefix(bound_field.name)
+
+            if isinstance(field.widget, HiddenInput):
+                fixed.update(self.generate_dummy_data(template, bound_field,
+                    param_name, []))
+            else:
+                generators.append((param_name, field, dummy_value_generator(
+                    self, field, bound_field.name,
+                    unique.get(bound_field.name))))
+
+        if post_data is not None:
+            fixed.update(post_data)
+
+        if count is None:
+            indexes = itertools.count(start)
+        else:
+            indexes = xrange(start, start + count)
+
+        for index in indexes:
+            payload = dict(fixed)
+            for param_name, field, generate in generators:
+                add_dummy_value(payload, field, param_name,
+                    generate(index, rng))
+            yield payload
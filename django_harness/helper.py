@@ -1,3 +1,33 @@
+from __future__ import unicode_literals, absolute_import
+
 import collections
 
 BreadCrumb = collections.namedtuple("BreadCrumb", ["title", "url"])
+
+class LazyMessage(object):
+    """
+    An assertion message that isn't built until it's converted to a string,
+    which only happens if the assertion fails, so that it can include
+    expensive diagnostics such as a whole pretty-printed response. It can
+    be added to strings and to other LazyMessages, for use as a msg_prefix.
+    """
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __unicode__(self):
+        from django.utils.encoding import force_text
+        return force_text(self.function(*self.args))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __add__(self, other):
+        return LazyMessage(lambda: unicode(self) + unicode(other))
+
+    def __radd__(self, other):
+        return LazyMessage(lambda: unicode(other) + unicode(self))
+
+    def __nonzero__(self):
+        return True
@@ -0,0 +1,142 @@
+"""
+Compares HTML structurally, with the same rules as django.test.html (used
+by assertInHTML and assertContains(html=True)), but parsing with lxml and
+counting matches by comparing hashes of subtrees, which is much faster on
+large pages:
+
+* attributes are compared in any order, class names in any order, and
+  boolean attributes (<input checked>) equal to their name;
+* runs of whitespace in text are collapsed, text is stripped, and
+  whitespace-only text and comments are ignored.
+
+Unlike Django's parser, lxml's HTML parser fixes up invalid markup (e.g.
+closing a <p> before a <div>), and decodes entities, so &amp; and &#38; are
+the same.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import collections
+import re
+
+from lxml import html
+
+WHITESPACE = re.compile(r'\s+')
+XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*>')
+DOCUMENT = re.compile(r'^\s*(<!DOCTYPE[^>]*>\s*)?<html[\s>]', re.IGNORECASE)
+
+class CanonicalTree(object):
+    """
+    Parses HTML into nested tuples of (tag, attributes, children), where
+    children are canonical elements or text, and indexes every element by
+    a hash of its subtree, computed bottom-up so that it takes linear time.
+
+    root is the only top-level element, or a list of top-level nodes if
+    there are several (or text), as with django.test.html.RootElement.
+    """
+
+    def __init__(self, text):
+        # subtree hash => list of canonical elements
+        self.by_hash = collections.defaultdict(list)
+
+        text = XML_DECLARATION.sub('', text, count=1)
+        if DOCUMENT.match(text):
+            nodes = [html.document_fromstring(text)]
+        elif text.strip():
+            nodes = html.fragments_fromstring(text)
+        else:
+            nodes = []
+
+        if nodes and isinstance(nodes[0], basestring):
+            leading_text = nodes.pop(0)
+        else:
+            leading_text = None
+
+        children, hashes = self.canonical_children(leading_text, nodes)
+
+        if len(children) == 1 and isinstance(children[0], tuple):
+            self.root = children[0]
+            self.root_hash = hashes[0]
+        else:
+            self.root = children
+            self.root_hash = None
+
+    def canonical_children(self, text, children):
+        nodes = []
+        hashes = []
+        texts = [text or '']
+
+        def flush_text():
+            joined = WHITESPACE.sub(' ', ''.join(texts)).strip()
+            if joined:
+                nodes.append(joined)
+                hashes.append(hash(joined))
+            del texts[:]
+
+        for child in children:
+            if isinstance(child.tag, basestring):
+                flush_text()
+                node, node_hash = self.canonical_element(child)
+                nodes.append(node)
+                hashes.append(node_hash)
+            # else it's a comment or processing instruction, but its tail
+            # is still part of the text
+
+            texts.append(child.tail or '')
+
+        flush_text()
+        return nodes, hashes
+
+    def canonical_element(self, element):
+        attributes = []
+        for name, value in element.attrib.items():
+            if name == 'class':
+                value = " ".join(sorted(value.split()))
+            attributes.append((name, value))
+        attributes = tuple(sorted(attributes))
+
+        children, child_hashes = self.canonical_children(element.text,
+            element)
+        node = (element.tag, attributes, tuple(children))
+        node_hash = hash((element.tag, attributes, tuple(child_hashes)))
+        self.by_hash[node_hash].append(node)
+        return node, node_hash
+
+    def count(self, needle):
+        """
+        The number of times that another CanonicalTree (needle) occurs in
+        this one, as django.test.html.Element.count() would count it.
+        """
+
+        if needle.root_hash is None:
+            # several nodes, or text: Django only matches a whole document
+            if isinstance(self.root, list) and self.root == needle.root:
+                return 1
+            return 0
+
+        return sum(1 for node in self.by_hash.get(needle.root_hash, ())
+            if node == needle.root)
+
+def count_in_html(needle, haystack):
+    """
+    The number of times that the HTML needle occurs in haystack, both
+    unicode strings.
+    """
+
+    return CanonicalTree(haystack).count(CanonicalTree(needle))
+
+def assert_count(testcase, needle, haystack, count, msg_prefix, text_repr):
+    """
+    Makes the same assertions as Django's assertInHTML and
+    assertContains(html=True), with the same messages.
+    """
+
+    real_count = count_in_html(needle, haystack)
+
+    if count is not None:
+        testcase.assertEqual(real_count, count,
+            msg_prefix + "Found %d instances of %s in response"
+            " (expected %d)" % (real_count, text_repr, count))
+    else:
+        testcase.assertTrue(real_count != 0,
+            msg_prefix + "Couldn't find %s in response" % text_repr)
@@ -1,20 +1,410 @@
 from __future__ import unicode_literals, absolute_import
 
+import collections
+import re
+
 from cssselect import GenericTranslator
 from htmlentitydefs import name2codepoint
 from lxml import etree
 import six
 
+from django_harness.helper import LazyMessage
+
+
+class XPathCache(object):
+    """
+    A least-recently-used cache of compiled etree.XPath objects (and CSS
+    selector matchers), shared by all tests in the process, because
+    compiling a CSS selector or XPath expression often takes longer than
+    evaluating it.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.store = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compile_function, *args):
+        try:
+            compiled = self.store.pop(key)
+            self.hits += 1
+        except KeyError:
+            compiled = compile_function(*args)
+            self.misses += 1
+
+            while self.store and len(self.store) >= self.maxsize:
+                self.store.popitem(last=False)
+
+        # (re)insert as the most recently used
+        self.store[key] = compiled
+        return compiled
+
+    def clear(self):
+        self.store.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self.store),
+            maxsize=self.maxsize)
+
+xpath_cache = XPathCache()
+
+
+class ParseCache(object):
+    """
+    A least-recently-used cache of parsed trees, keyed by a hash of the
+    content, so that the same page returned in many responses (e.g. the same
+    CMS page for different users) is only parsed once. get() returns a deep
+    copy of the cached tree, which is several times faster than parsing
+    again, so that tests can't modify each others' trees.
+
+    The memory used by each tree is estimated from the length of the
+    content: libxml2 trees of typical pages take about 14 times as much.
+    """
+
+    TREE_SIZE_FACTOR = 14
+
+    def __init__(self, max_megabytes=100):
+        self.max_megabytes = max_megabytes
+        self.store = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, content, *extra):
+        import hashlib
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+            extra += ('unicode',)
+        return (hashlib.sha1(content).digest(), len(content)) + extra
+
+    def get(self, key, parse_function, *args):
+        import copy
+
+        try:
+            root, size = self.store.pop(key)
+            self.hits += 1
+        except KeyError:
+            root = parse_function(*args)
+            size = key[1] * self.TREE_SIZE_FACTOR
+            self.misses += 1
+
+            max_size = self.max_megabytes * 1024 * 1024
+            if size > max_size:
+                # too big to cache at all, so don't evict anything for it
+                return root
+
+            self.size += size
+            while self.store and self.size > max_size:
+                old_key, (old_root, old_size) = self.store.popitem(last=False)
+                self.size -= old_size
+
+        # (re)insert as the most recently used
+        self.store[key] = (root, size)
+        return copy.deepcopy(root)
+
+    def clear(self):
+        self.store.clear()
+        self.size = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, trees=len(self.store),
+            megabytes=self.size / 1024.0 / 1024,
+            max_megabytes=self.max_megabytes)
+
+parse_cache = ParseCache()
+
+
+class ElementIndex(object):
+    """
+    Lists of the elements in a tree with each id, name and class, in
+    document order, so that simple queries don't have to scan the whole
+    tree. The index is not updated if the tree is modified.
+    """
+
+    def __init__(self, root):
+        self.by_id = {}
+        self.by_name = {}
+        self.by_class = {}
+
+        for element in root.iter(etree.Element):
+            get = element.get
+
+            id = get('id')
+            if id is not None:
+                self.by_id.setdefault(id, []).append(element)
+
+            name = get('name')
+            if name is not None:
+                self.by_name.setdefault(name, []).append(element)
+
+            classes = get('class')
+            if classes is not None:
+                for class_name in set(classes.split()):
+                    self.by_class.setdefault(class_name, []).append(element)
+
+    def lookup(self, kind, value, tag=None):
+        """
+        Returns the elements with the given id, name or class (kind), and
+        tag if not None.
+        """
+
+        elements = getattr(self, 'by_' + kind).get(value, [])
+
+        if tag is not None:
+            elements = [e for e in elements if e.tag == tag]
+
+        return elements
+
+SIMPLE_SELECTOR = re.compile(r"""^([A-Za-z][\w-]*)?(?:
+    \#(?P<id>[A-Za-z_][\w-]*) |
+    \.(?P<class>[A-Za-z_][\w-]*) |
+    \[name=(?:"(?P<dq>[^"\\]*)"|'(?P<sq>[^'\\]*)'|(?P<name>[A-Za-z_][\w-]*))\]
+    )$""", re.VERBOSE)
+
+def parse_simple_selector(selector):
+    """
+    Returns (kind, value, tag) if selector is a single #id, .class or
+    [name=...] selector, optionally with a tag name, which can be answered
+    by an ElementIndex, or None otherwise.
+    """
+
+    match = SIMPLE_SELECTOR.match(selector.strip())
+    if match is None:
+        return None
+
+    tag = match.group(1)
+    if match.group('id') is not None:
+        return ('id', match.group('id'), tag)
+    elif match.group('class') is not None:
+        return ('class', match.group('class'), tag)
+
+    for group in ('dq', 'sq', 'name'):
+        if match.group(group) is not None:
+            return ('name', match.group(group), tag)
+
+
+def local_name(element):
+    return element.tag.rpartition('}')[2]
+
+def normalized_text(element):
+    return re.sub(r'\s+', ' ', ''.join(element.itertext())).strip()
+
+FORM_FIELD_TAGS = ('input', 'select', 'textarea')
+
+def find_named_field(parent, after=None):
+    """
+    Returns the name of the first form field in parent (after the element
+    after, if not None), or None.
+    """
+
+    seen_after = after is None
+    for element in parent.iter(etree.Element):
+        if element is after:
+            seen_after = True
+        elif seen_after and local_name(element) in FORM_FIELD_TAGS and \
+                element.get('name'):
+            return element.get('name')
+
+def is_errorlist(element):
+    return (isinstance(element.tag, basestring) and
+        local_name(element) == 'ul' and
+        'errorlist' in (element.get('class') or '').split())
+
+def follows_field_row(errorlist):
+    """
+    Whether an errorlist comes after a field's <p> (or another errorlist)
+    rendered by Form.as_p(), so it can't be the list of non-field errors,
+    which as_p() puts before all of them.
+    """
+
+    for sibling in errorlist.itersiblings(preceding=True):
+        if not isinstance(sibling.tag, basestring):
+            continue
+        if is_errorlist(sibling):
+            return True
+        if local_name(sibling) == 'p' and find_named_field(sibling):
+            return True
+    return False
+
+def find_error_field(errorlist):
+    """
+    Returns the name of the field that a <ul class="errorlist"> belongs
+    to, as rendered by Form.as_table(), as_ul(), as_p() and the admin, or
+    '__all__' for non-field errors.
+
+    Django 1.6 doesn't mark non-field errors with a class, and as_p()
+    renders them just like the first field's errors, before its <p>. A list
+    before all the fields (and their errors) is taken to be non-field
+    errors; see find_possible_error_field().
+    """
+
+    if 'nonfield' in errorlist.get('class').split():
+        return '__all__'
+
+    parent = errorlist.getparent()
+
+    # as_table() and as_ul(): in the same cell or item as the field
+    if parent is not None and local_name(parent) in ('td', 'li'):
+        name = find_named_field(parent, after=errorlist)
+        if name is not None:
+            return name
+
+    # as_p(): before the paragraph with the field
+    next = errorlist.getnext()
+    if next is not None and local_name(next) == 'p' and \
+            follows_field_row(errorlist):
+        name = find_named_field(next)
+        if name is not None:
+            return name
+
+    # admin: inside <div class="form-row field-name"> or field-box
+    for ancestor in errorlist.iterancestors():
+        if local_name(ancestor) == 'form':
+            break
+        for class_name in (ancestor.get('class') or '').split():
+            if class_name.startswith('field-') and class_name != 'field-box':
+                return class_name[len('field-'):]
+
+    return '__all__'
+
+def find_possible_error_field(errorlist):
+    """
+    Returns the name of the first field rendered by as_p(), if errorlist
+    could be its errors rather than non-field errors, or None.
+    """
+
+    next = errorlist.getnext()
+    if next is not None and local_name(next) == 'p' and \
+            not follows_field_row(errorlist):
+        return find_named_field(next)
+
+class FormErrors(collections.OrderedDict):
+    """
+    All the form errors on a page, in document order, as a dictionary of
+    field name => list of messages, with non-field errors under '__all__'.
+    notes is a list of (kind, message) for the other error messages:
+    'error-message' divs, admin 'errornote' paragraphs and 'errors-cell'
+    table cells.
+
+    possible is a dictionary of field name => messages listed under
+    '__all__' that could also be that field's errors (see find_error_field).
+    """
+
+    def __init__(self, root=None):
+        super(FormErrors, self).__init__()
+        self.notes = []
+        self.possible = {}
+
+        if root is not None:
+            self.collect(root)
+
+    def collect(self, root):
+        for element in root.iter(etree.Element):
+            classes = element.get('class')
+            if not classes:
+                continue
+
+            classes = classes.split()
+            tag = local_name(element)
+
+            if tag == 'ul' and 'errorlist' in classes:
+                messages = [normalized_text(item) for item in element
+                    if isinstance(item.tag, basestring)]
+                field = find_error_field(element)
+                self.setdefault(field, []).extend(messages)
+
+                if field == '__all__':
+                    possible_field = find_possible_error_field(element)
+                    if possible_field is not None:
+                        self.possible.setdefault(possible_field,
+                            []).extend(messages)
+            elif tag == 'div' and 'error-message' in classes:
+                self.notes.append(('error-message', normalized_text(element)))
+            elif tag == 'p' and 'errornote' in classes:
+                self.notes.append(('errornote', normalized_text(element)))
+            elif tag == 'td' and 'errors-cell' in classes:
+                self.notes.append(('errors-cell', normalized_text(element)))
+
+    def first_note(self, *kinds):
+        for kind, message in self.notes:
+            if kind in kinds:
+                return message
+
+    def format(self):
+        lines = ["%s: %s" % (kind, message) for kind, message in self.notes]
+        for field, messages in self.iteritems():
+            for message in messages:
+                lines.append("%s: %s" % (field, message))
+        return "\n".join(lines)
+
+def iter_content_chunks(response, chunk_size=65536):
+    """
+    Yields the content of a response in chunks, without reading all of a
+    StreamingHttpResponse into memory, or copying all of a normal one.
+    """
+
+    if getattr(response, 'streaming', False):
+        for chunk in response.streaming_content:
+            yield chunk
+    else:
+        content = response.content
+        for start in range(0, len(content), chunk_size):
+            yield content[start:start + chunk_size]
+
+def iter_parse_events(parser, chunks):
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event in parser.read_events():
+            yield event
+
+    parser.close()
+    for event in parser.read_events():
+        yield event
+
 
 class HtmlParsingMixin(object):
-    def parse(self, response):
+    # 'xml' parses pages as strict XHTML, which also checks that they are
+    # well-formed; 'html' uses lxml's HTML parser, which accepts pages that
+    # aren't, but is slower (about 1.5 times, see benchmarks.py), because
+    # it has to put elements into their xmlns namespaces itself.
+    parse_engine = 'xml'
+
+    # build an ElementIndex when parsing a response, to answer simple
+    # id, name and class queries without scanning the whole tree
+    build_parse_index = False
+
+    # reuse trees parsed from identical content, from parse_cache
+    use_parse_cache = False
+
+    # 'django' compares HTML in assertInHTML and assertContains(html=True)
+    # with django.test.html, and 'lxml' with html_compare, which is much
+    # faster on large pages
+    html_compare_engine = 'django'
+
+    def parse(self, response, engine=None, index=None):
         if hasattr(response, 'parsed'):
             # already parsed
             return response.parsed
 
+        if engine is None:
+            engine = self.parse_engine
+
+        if engine not in ('xml', 'html'):
+            raise Exception("Unknown parse engine: %s" % engine)
+
         from django.utils.safestring import SafeText
         if isinstance(response, SafeText) or isinstance(response, six.string_types):
             content = response
+            encoding = None
         else:
             from django.template.response import SimpleTemplateResponse
             if isinstance(response, SimpleTemplateResponse):
@@ -36,7 +426,43 @@ class HtmlParsingMixin(object):
                 raise Exception("Response is HTML but unexpectedly has no "
                     "content: %s: %s" % (response.status_code, response))
 
-            content = unicode(response.content, 'utf-8')
+            content = response.content
+            encoding = charset.partition('=')[2].strip() or 'utf-8'
+
+        if self.use_parse_cache:
+            # The key includes the parse function, in case a subclass
+            # overrides it.
+            parse_function = getattr(type(self), 'parse_' + engine).__func__
+            key = parse_cache.make_key(content, encoding, engine,
+                parse_function)
+            root = parse_cache.get(key, self.parse_content, content,
+                encoding, engine)
+        else:
+            root = self.parse_content(content, encoding, engine)
+
+        if 'content' in dir(response):
+            response.parsed = root
+
+            if index is None:
+                index = self.build_parse_index
+            if index:
+                response.parsed_index = ElementIndex(root)
+
+        return root
+
+    def parse_content(self, content, encoding, engine):
+        if engine == 'html':
+            return self.parse_html(content, encoding)
+        else:
+            if encoding is not None:
+                content = unicode(content, encoding)
+            return self.parse_xml(content)
+
+    def parse_xml(self, content):
+        """
+        Parse content as strict XML, with the HTML entities defined, and
+        print the context of any syntax error.
+        """
 
         if hasattr(self, 'entity_cache'):
             entities = self.entity_cache
@@ -111,8 +537,38 @@ class HtmlParsingMixin(object):
 
             raise e
 
-        if 'content' in dir(response):
-            response.parsed = root
+        return root
+
+    def parse_html(self, content, encoding=None):
+        """
+        Parse content (bytes in the given encoding, or unicode) with lxml's
+        HTML parser. Elements are put in the namespaces given by any xmlns
+        attributes, as the XML parser would, so that xhtml() works the same
+        with both engines. As with the XML parser, they are plain lxml.etree
+        elements, not lxml.html ones, which are slower to iterate over.
+        """
+
+        from lxml import html
+        parser = etree.HTMLParser(remove_blank_text=True, encoding=encoding)
+        root = html.fromstring(content, parser=parser)
+
+        marker = b'xmlns' if isinstance(content, bytes) else 'xmlns'
+        if marker in content:
+            # old tag => namespaced tag, so that we only format each once
+            tags = {}
+
+            # in document order, so inner declarations override outer ones
+            for scope in root.xpath('descendant-or-self::*[@xmlns]'):
+                namespace = scope.attrib.pop('xmlns')
+                tags.clear()
+
+                for element in scope.iter(etree.Element):
+                    tag = element.tag
+                    new_tag = tags.get(tag)
+                    if new_tag is None:
+                        new_tag = tags[tag] = '{%s}%s' % (namespace,
+                            tag.rpartition('}')[2])
+                    element.tag = new_tag
 
         return root
 
@@ -124,19 +580,39 @@ class HtmlParsingMixin(object):
     def tostring(self, element):
         return etree.tostring(element, pretty_print=True)
 
+    def compile_xpath(self, xpath):
+        return xpath_cache.get(xpath, etree.XPath, xpath)
+
+    def compile_selector(self, selector):
+        return xpath_cache.get((self.translator.__class__, selector),
+            lambda: etree.XPath(self.translator.css_to_xpath(selector)))
+
     def find_within(self, parent, xpath, required=True, list=False):
+        """
+        xpath may be a string or a compiled etree.XPath (e.g. from
+        compile_selector).
+        """
+
         try:
-            children = parent.xpath(xpath)
+            if isinstance(xpath, etree.XPath):
+                compiled = xpath
+                xpath = compiled.path
+            else:
+                compiled = self.compile_xpath(xpath)
+            children = compiled(parent)
         except SyntaxError as e:
             import sys
             ex = sys.exc_info()
             raise ex[0], "Failed to execute XPath query: %s: %s" % \
                 (xpath, ex[1]), ex[2]
 
+        return self.check_found(parent, children, xpath, required, list)
+
+    def check_found(self, parent, children, xpath, required, list):
         if required:
-            self.assertNotEqual(0, len(children),
+            self.assertNotEqual(0, len(children), LazyMessage(lambda:
                 "Failed to find '%s' in section:\n\n%s" %
-                (xpath, self.tostring(parent)))
+                (xpath, self.tostring(parent))))
 
         if list:
             return children
@@ -154,58 +630,319 @@ class HtmlParsingMixin(object):
 
     translator = GenericTranslator()
 
-    def query(self, response_or_element, selector, required=True, list=False):
+    def get_query_root(self, response_or_element):
         from django.utils.safestring import SafeText
 
         if 'content' in dir(response_or_element):
             # it's an HTTP response, so parse it to get root element
-            ancestor = self.parse(response_or_element)
+            return self.parse(response_or_element)
         elif isinstance(response_or_element, SafeText) or \
             isinstance(response_or_element, six.string_types):
-            ancestor = self.parse(response_or_element)
+            return self.parse(response_or_element)
         else:
-            ancestor = response_or_element
+            return response_or_element
+
+    def get_parse_index(self, response_or_element):
+        if 'content' in dir(response_or_element):
+            return getattr(response_or_element, 'parsed_index', None)
+
+    def query(self, response_or_element, selector, required=True, list=False):
+        ancestor = self.get_query_root(response_or_element)
+        index = self.get_parse_index(response_or_element)
+        simple = None if index is None else parse_simple_selector(selector)
 
         try:
+            if simple is not None:
+                kind, value, tag = simple
+                return self.check_found(ancestor, index.lookup(kind, value,
+                    tag), selector, required, list)
+
             return self.find_within(ancestor,
-                self.translator.css_to_xpath(selector), required, list)
+                self.compile_selector(selector), required, list)
         except self.failureException as e:
             raise self.failureException("Failed to find <%s> in section:\n%s" %
                 (selector, e))
 
+    def compile_matcher(self, selector):
+        from django_harness.css_matching import compile_matcher
+        return xpath_cache.get(('matcher', selector), compile_matcher,
+            selector)
+
+    def query_many(self, response_or_element, selectors, required=True,
+        list=False):
+
+        """
+        Finds the elements matching each of a dictionary of name => CSS
+        selector, in a single pass over the tree, and returns a dictionary
+        of name => first matching element (or None), or list of matching
+        elements if list is True. If required, fails listing all the
+        selectors that didn't match anything.
+
+        Selectors that css_matching doesn't support are run as XPath.
+        """
+
+        from django_harness.css_matching import MatcherSet
+        ancestor = self.get_query_root(response_or_element)
+
+        matchers = {}
+        unsupported = []
+        for name, selector in selectors.iteritems():
+            compiled = self.compile_matcher(selector)
+            if compiled is None:
+                unsupported.append(name)
+            else:
+                matchers[name] = compiled
+
+        if matchers:
+            results = MatcherSet(matchers).match_all(ancestor,
+                first_only=not list)
+        else:
+            results = {}
+
+        for name in unsupported:
+            results[name] = self.find_within(ancestor,
+                self.compile_selector(selectors[name]), required=False,
+                list=True)
+
+        if required:
+            missing = sorted(name for name in selectors if not results.get(name))
+            if missing:
+                self.fail("Failed to find %d of %d selectors in section:\n"
+                    "%s\n\n%s" % (len(missing), len(selectors),
+                        "\n".join("%s: <%s>" % (name, selectors[name])
+                            for name in missing),
+                        self.tostring(ancestor)))
+
+        if list:
+            return dict((name, results.get(name, []))
+                for name in selectors)
+        else:
+            return dict((name, results[name][0] if results.get(name) else None)
+                for name in selectors)
+
+    def stream_query(self, response, selectors, required=True,
+        chunk_size=65536):
+
+        """
+        Like query_many(), but parses the response incrementally with lxml's
+        HTML parser, stopping as soon as each selector has matched, and
+        throwing away the elements that have been checked, so that memory
+        use doesn't grow with the size of the response. Works with
+        StreamingHttpResponse, whose content is consumed.
+
+        Returns a dictionary of name => first matching element (or None),
+        as detached copies. Only the selectors supported by css_matching
+        can be used.
+        """
+
+        import copy
+        from django_harness.css_matching import MatcherSet
+
+        matchers = {}
+        for name, selector in selectors.iteritems():
+            compiled = self.compile_matcher(selector)
+            if compiled is None:
+                raise Exception("Selector can't be matched while parsing: %s"
+                    % selector)
+            matchers[name] = compiled
+        matcher_set = MatcherSet(matchers)
+
+        if isinstance(response, six.string_types):
+            content = response
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+            encoding = 'utf-8'
+            chunks = (content[start:start + chunk_size]
+                for start in range(0, len(content), chunk_size))
+        else:
+            mime_type, _, charset = response['Content-Type'].partition(';')
+            encoding = charset.partition('=')[2].strip() or 'utf-8'
+            chunks = iter_content_chunks(response, chunk_size)
+
+        parser = etree.HTMLPullParser(events=('start', 'end'),
+            remove_blank_text=True, encoding=encoding)
+
+        root = None
+        # namespaces from xmlns attributes, as in parse_html()
+        namespaces = [None]
+        # matching element => names, until we see its end
+        pending = {}
+        matched = set()
+        results = {}
+
+        for event, element in iter_parse_events(parser, chunks):
+            if event == 'start':
+                namespace = element.attrib.pop('xmlns', namespaces[-1])
+                namespaces.append(namespace)
+                if namespace is not None:
+                    element.tag = '{%s}%s' % (namespace, element.tag)
+
+                if root is None:
+                    root = element
+
+                names = matcher_set.match(element, root, matched)
+                if names:
+                    pending[element] = names
+                    matched.update(names)
+                continue
+
+            namespaces.pop()
+            names = pending.pop(element, None)
+            if names:
+                found = copy.deepcopy(element)
+                for name in names:
+                    results[name] = found
+
+            if len(results) == len(matcher_set.names):
+                break
+
+            if not pending:
+                # Nothing that we still need is inside this element, or
+                # its preceding siblings. The root element has no parent,
+                # but can have siblings, such as comments before <html>.
+                element.clear()
+                parent = element.getparent()
+                if parent is not None:
+                    while element.getprevious() is not None:
+                        del parent[0]
+
+        if required:
+            missing = sorted(name for name in selectors if name not in results)
+            if missing:
+                self.fail("Failed to find %d of %d selectors in streamed "
+                    "response:\n%s" % (len(missing), len(selectors),
+                        "\n".join("%s: <%s>" % (name, selectors[name])
+                            for name in missing)))
+
+        return dict((name, results.get(name)) for name in selectors)
+
     def first_child(self, element, message=''):
         if message:
             message = message + ': '
 
-        self.assertNotEqual(0, len(element), message +
-            "%s does not have any children" % self.tostring(element))
+        self.assertNotEqual(0, len(element), message + LazyMessage(lambda:
+            "%s does not have any children" % self.tostring(element)))
         return element[0]
 
-    def extract_error_message(self, response):
-        self.parse(response)
+    def extract_form_errors(self, response):
+        """
+        Returns a FormErrors with all the form errors in the response (or
+        element), found in a single pass over the tree the first time, and
+        saved on the response as response.form_errors.
+        """
+
+        if hasattr(response, 'form_errors'):
+            return response.form_errors
+
+        form_errors = FormErrors(self.get_query_root(response))
 
-        error_message = response.parsed.findtext('.//' +
-            self.xhtml('div') + '[@class="error-message"]')
+        if 'content' in dir(response):
+            response.form_errors = form_errors
+
+        return form_errors
 
-        if error_message is None:
-            error_message = response.parsed.findtext('.//' +
-                self.xhtml('p') + '[@class="errornote"]')
+    def extract_error_message(self, response):
+        form_errors = self.extract_form_errors(response)
+        error_message = form_errors.first_note('error-message', 'errornote')
 
         if error_message is not None:
             # extract individual field errors, if any
-            more_error_messages = response.parsed.findtext('.//' +
-                self.xhtml('td') + '[@class="errors-cell"]')
+            more_error_messages = form_errors.first_note('errors-cell')
             if more_error_messages is not None:
                 error_message += more_error_messages
 
             # trim and canonicalise whitespace
-            error_message = error_message.strip()
-            import re
-            error_message = re.sub('\\s+', ' ', error_message)
+            error_message = re.sub('\\s+', ' ', error_message.strip())
 
         # return message or None
         return error_message
 
+    def assert_no_form_errors(self, response, message=''):
+        if message:
+            message = message + ': '
+
+        form_errors = self.extract_form_errors(response)
+        if form_errors or form_errors.notes:
+            self.fail(message + "Unexpected form errors:\n%s" %
+                form_errors.format())
+
+    def assert_form_error(self, response, field, error=None):
+        """
+        Asserts that field ('__all__' for non-field errors) has an error,
+        or the given error if not None. For the first field of a form
+        rendered with as_p(), errors that can't be told apart from non-field
+        errors count as both.
+        """
+
+        form_errors = self.extract_form_errors(response)
+        messages = form_errors.get(field, []) + \
+            form_errors.possible.get(field, [])
+
+        if (error is None and not messages) or \
+                (error is not None and error not in messages):
+            self.fail("Expected %s on field %s, but the errors were:\n%s" %
+                ("an error" if error is None else "error '%s'" % error,
+                    field, form_errors.format() or "(none)"))
+
+    def extract_form_values(self, form):
+        """
+        Returns an OrderedDict of name => list of values for the fields in
+        a <form> element that a browser would submit: enabled fields with a
+        name, checkboxes and radio buttons only if checked, selected options
+        (or the first option of a single select), and no buttons or files.
+        """
+
+        values = collections.OrderedDict()
+
+        for element in form.iter(etree.Element):
+            tag = local_name(element)
+            name = element.get('name')
+
+            if tag not in FORM_FIELD_TAGS or not name or \
+                    element.get('disabled') is not None:
+                continue
+
+            if any(local_name(ancestor) == 'fieldset' and
+                    ancestor.get('disabled') is not None
+                    for ancestor in element.iterancestors()):
+                continue
+
+            if tag == 'input':
+                input_type = (element.get('type') or 'text').lower()
+                if input_type in ('submit', 'image', 'button', 'reset',
+                        'file'):
+                    continue
+                elif input_type in ('checkbox', 'radio'):
+                    if element.get('checked') is None:
+                        continue
+                    field_values = [element.get('value', 'on')]
+                else:
+                    field_values = [element.get('value', '')]
+            elif tag == 'select':
+                options = [option for option in element.iter(etree.Element)
+                    if local_name(option) == 'option']
+                selected = [option for option in options
+                    if option.get('selected') is not None]
+                if not selected and options and \
+                        element.get('multiple') is None:
+                    selected = options[:1]
+                field_values = [option.get('value', normalized_text(option))
+                    for option in selected]
+            else:
+                # browsers ignore a newline straight after <textarea>, which
+                # Django's Textarea widget always renders
+                text = ''.join(element.itertext())
+                for newline in ('\r\n', '\n', '\r'):
+                    if text.startswith(newline):
+                        text = text[len(newline):]
+                        break
+                field_values = [text]
+
+            if field_values:
+                values.setdefault(name, []).extend(field_values)
+
+        return values
+
     def assert_get_management_form(self, get_response_or_parent_element,
         prefix):
 
@@ -219,12 +956,19 @@ class HtmlParsingMixin(object):
         else:
             parent = get_response_or_parent_element
 
-        total = self.find_within(parent,
-            './/input[@id="id_%s-TOTAL_FORMS"]' % prefix)
-        initial = self.find_within(parent,
-            './/input[@id="id_%s-INITIAL_FORMS"]' % prefix)
-        max_num = self.find_within(parent,
-            './/input[@id="id_%s-MAX_NUM_FORMS"]' % prefix)
+        index = self.get_parse_index(get_response_or_parent_element)
+
+        def find_input(id):
+            xpath = './/input[@id="%s"]' % id
+            if index is None:
+                return self.find_within(parent, xpath)
+            else:
+                return self.check_found(parent,
+                    index.lookup('id', id, 'input'), xpath, True, False)
+
+        total = find_input("id_%s-TOTAL_FORMS" % prefix)
+        initial = find_input("id_%s-INITIAL_FORMS" % prefix)
+        max_num = find_input("id_%s-MAX_NUM_FORMS" % prefix)
 
         return dict(
             (element.get('name'), element.get('value'))
@@ -235,8 +979,18 @@ class HtmlParsingMixin(object):
         if msg_prefix:
             msg_prefix = msg_prefix + ': '
 
-        msg_prefix = haystack + "\n\n" + msg_prefix
-
-        return super(HtmlParsingMixin, self).assertInHTML(needle, haystack,
-            count, msg_prefix)
+        try:
+            if self.html_compare_engine == 'lxml':
+                from django_harness import html_compare
+                html_compare.assert_count(self, needle, haystack, count,
+                    msg_prefix, "'%s'" % needle)
+            else:
+                return super(HtmlParsingMixin, self).assertInHTML(needle,
+                    haystack, count, msg_prefix)
+        except AssertionError as e:
+            # Only add the haystack to the message if the assertion fails
+            import sys
+            exc_info = sys.exc_info()
+            raise exc_info[0], "%s\n\nThe haystack was:\n%s" % (e,
+                haystack), exc_info[2]
 
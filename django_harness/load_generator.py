@@ -0,0 +1,278 @@
+"""
+Replay recorded view requests through FastDispatchMixin.fast_dispatch in
+several worker processes, and report the throughput and the latency
+percentiles for each view, without a web server or network in the way.
+
+The requests file contains one JSON object per line, each of which holds
+fast_dispatch() keyword arguments, for example:
+
+    {"view_name": "home"}
+    {"view_name": "article", "url_kwargs": {"slug": "hello"}, "language": "fr"}
+    {"view_name": "search", "get_params": {"q": "water"}, "user": "admin"}
+
+where "user" is the username of an existing User to attach to the request.
+
+Usage:
+
+    python -m django_harness.load_generator --settings=myproject.settings \\
+        --workers=4 --repeat=100 requests.jsonl
+
+The views run against the database configured in the settings, and any
+changes that they make are not rolled back, so point it at a disposable
+database. Use --save-report to record the results as JSON, and --baseline
+with a previously saved report to fail (exit status 1) if the p95 latency
+of any view has grown by more than --tolerance.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+from timeit import default_timer
+
+
+def make_dispatcher():
+    # fast_dispatch can only be imported once the settings are known
+    from django_harness.fast_dispatch import FastDispatchMixin
+
+    class LoadGeneratorDispatcher(FastDispatchMixin):
+        """
+        FastDispatchMixin isn't usually used outside a TestCase, but it only
+        needs an object to hang itself on.
+        """
+
+        def __init__(self):
+            self.users = {}
+
+        def get_user(self, username):
+            if username not in self.users:
+                from django.contrib.auth.models import User
+                self.users[username] = User.objects.get(username=username)
+            return self.users[username]
+
+        def replay(self, specs):
+            """
+            Dispatch each spec in turn, returning a list of (view_name,
+            elapsed, status_code, error) tuples, where status_code is None
+            and error is the repr() of the exception if the view raised one.
+            """
+
+            timings = []
+
+            for spec in specs:
+                spec = dict((str(key), value) for key, value in spec.iteritems())
+                if 'user' in spec:
+                    spec['user'] = self.get_user(spec['user'])
+
+                try:
+                    result = self.fast_dispatch_many([spec])[0]
+                except Exception as e:
+                    timings.append((spec['view_name'], None, None, repr(e)))
+                else:
+                    timings.append((spec['view_name'], result.elapsed,
+                        result.response.status_code, None))
+
+            return timings
+
+    return LoadGeneratorDispatcher()
+
+
+dispatcher = None
+
+def setup_worker():
+    try:
+        # Django 1.7 and above need to be set up explicitly
+        from django import setup
+        setup()
+    except ImportError:
+        pass
+
+    # Don't share the parent process' database connections
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
+
+    global dispatcher
+    dispatcher = make_dispatcher()
+
+
+def run_worker(specs):
+    return dispatcher.replay(specs)
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+
+    if not sorted_values:
+        return None
+
+    # not percent / 100.0 * n, which can come out just above an integer
+    rank = int(math.ceil(percent * len(sorted_values) / 100.0)) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def summarise(timings, wall_time):
+    by_view = {}
+    for view_name, elapsed, status_code, error in timings:
+        by_view.setdefault(view_name, []).append((elapsed, status_code,
+            error))
+
+    views = {}
+    for view_name, results in by_view.iteritems():
+        latencies = sorted(elapsed for elapsed, status_code, error in results
+            if elapsed is not None)
+        exceptions = [error for elapsed, status_code, error in results
+            if error is not None]
+        views[view_name] = dict(
+            requests=len(results),
+            errors=len([1 for elapsed, status_code, error in results
+                if status_code is None or status_code >= 500]),
+            first_error=exceptions[0] if exceptions else None,
+            mean=(sum(latencies) / len(latencies)) if latencies else None,
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            p99=percentile(latencies, 99),
+        )
+
+    return dict(
+        requests=len(timings),
+        wall_time=wall_time,
+        throughput=(len(timings) / wall_time) if wall_time else None,
+        views=views,
+    )
+
+
+def format_ms(seconds):
+    if seconds is None:
+        return "-"
+    return "%.2f" % (seconds * 1000)
+
+
+def print_report(report, out=sys.stdout):
+    out.write("%d requests in %.2fs: %.1f requests/s\n\n" % (
+        report['requests'], report['wall_time'], report['throughput'] or 0))
+
+    out.write("%-40s %8s %6s %10s %10s %10s %10s\n" % ("view", "requests",
+        "errors", "mean ms", "p50 ms", "p95 ms", "p99 ms"))
+
+    for view_name, stats in sorted(report['views'].iteritems()):
+        out.write("%-40s %8d %6d %10s %10s %10s %10s\n" % (view_name,
+            stats['requests'], stats['errors'], format_ms(stats['mean']),
+            format_ms(stats['p50']), format_ms(stats['p95']),
+            format_ms(stats['p99'])))
+
+    errors = [(view_name, stats['first_error']) for view_name, stats
+        in sorted(report['views'].iteritems()) if stats.get('first_error')]
+    if errors:
+        out.write("\nFirst exception raised by each view:\n")
+        for view_name, error in errors:
+            out.write("%s: %s\n" % (view_name, error))
+
+
+def find_regressions(report, baseline, tolerance):
+    regressions = []
+
+    for view_name, stats in sorted(report['views'].iteritems()):
+        old_stats = baseline['views'].get(view_name)
+        if old_stats is None or old_stats['p95'] is None or stats['p95'] is None:
+            continue
+
+        if stats['p95'] > old_stats['p95'] * (1 + tolerance):
+            regressions.append("%s: p95 %s ms, was %s ms" % (view_name,
+                format_ms(stats['p95']), format_ms(old_stats['p95'])))
+
+    return regressions
+
+
+def read_specs(filename):
+    specs = []
+    with open(filename) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            try:
+                spec = json.loads(line)
+            except ValueError as e:
+                raise Exception("%s line %d: %s" % (filename, line_number, e))
+
+            if 'view_name' not in spec:
+                raise Exception("%s line %d: no view_name: %s" %
+                    (filename, line_number, line))
+
+            specs.append(spec)
+    return specs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded requests "
+        "through fast_dispatch and report latency per view.")
+    parser.add_argument('requests_file', help="file of JSON request specs, "
+        "one per line")
+    parser.add_argument('--settings', help="Django settings module (default: "
+        "$DJANGO_SETTINGS_MODULE)")
+    parser.add_argument('--pythonpath', help="directory to add to the "
+        "Python path, e.g. the project root")
+    parser.add_argument('--workers', type=int,
+        default=multiprocessing.cpu_count(), help="number of worker "
+        "processes (default: one per CPU)")
+    parser.add_argument('--repeat', type=int, default=1,
+        help="number of times to replay each request (default: 1)")
+    parser.add_argument('--save-report', help="write the results as JSON "
+        "to this file")
+    parser.add_argument('--baseline', help="JSON report from an earlier run "
+        "to compare p95 latencies with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help="allowed fractional growth in p95 latency compared to the "
+        "baseline (default: 0.2)")
+    args = parser.parse_args(argv)
+
+    if args.pythonpath:
+        sys.path.insert(0, args.pythonpath)
+    if args.settings:
+        os.environ['DJANGO_SETTINGS_MODULE'] = args.settings
+
+    specs = read_specs(args.requests_file) * args.repeat
+    workers = max(1, min(args.workers, len(specs)))
+    # interleave the requests, so that each worker gets a similar mix
+    slices = [specs[i::workers] for i in range(workers)]
+
+    pool = multiprocessing.Pool(workers, setup_worker)
+    try:
+        start = default_timer()
+        results = pool.map(run_worker, slices)
+        wall_time = default_timer() - start
+    finally:
+        pool.close()
+        pool.join()
+
+    timings = [timing for result in results for timing in result]
+    report = summarise(timings, wall_time)
+    print_report(report)
+
+    if args.save_report:
+        with open(args.save_report, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = find_regressions(report, baseline, args.tolerance)
+        if regressions:
+            sys.stdout.write("\nLatency regressions:\n%s\n" %
+                "\n".join(regressions))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""
+A session engine that keeps sessions in a dictionary in memory, so that
+tests can create and modify sessions without any database writes. Use it
+with:
+
+    SESSION_ENGINE = 'django_harness.memory_session'
+
+Sessions never expire, and are lost when the process exits, so this is only
+useful for tests. The test client, fast_dispatch (after stuff_session) and
+any views running in the same process all see the same sessions.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+from django.contrib.sessions.backends.base import SessionBase, CreateError
+
+# session key => dictionary of session data
+_sessions = {}
+
+def clear_sessions():
+    _sessions.clear()
+
+class SessionStore(SessionBase):
+    def load(self):
+        try:
+            # Return a copy, so that unsaved changes are not shared.
+            return dict(_sessions[self.session_key])
+        except KeyError:
+            self.create()
+            return {}
+
+    def exists(self, session_key):
+        return session_key in _sessions
+
+    def create(self):
+        while True:
+            self._session_key = self._get_new_session_key()
+            try:
+                self.save(must_create=True)
+            except CreateError:
+                continue
+            self.modified = True
+            return
+
+    def save(self, must_create=False):
+        session_key = self._get_or_create_session_key()
+        if must_create and session_key in _sessions:
+            raise CreateError
+        _sessions[session_key] = dict(self._get_session(no_load=must_create))
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        _sessions.pop(session_key, None)
+
+    @classmethod
+    def clear_expired(cls):
+        pass
@@ -0,0 +1,65 @@
+from __future__ import unicode_literals, absolute_import
+
+import gc
+
+try:
+    import tracemalloc
+except ImportError as e:
+    # Not available on Python 2 without pytracemalloc, so we count objects
+    # instead, which still finds views that keep adding to caches.
+    tracemalloc = None
+
+
+class MemoryGrowthTracker(object):
+    """
+    Records how much memory each view retains after it has been dispatched,
+    measured in bytes allocated by Python if tracemalloc is tracing, or in
+    the number of objects tracked by the garbage collector otherwise.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # view name => list of growth measurements
+        self.by_view = {}
+
+    @property
+    def unit(self):
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            return "bytes"
+        else:
+            return "objects"
+
+    def measure(self):
+        gc.collect()
+
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            return current
+        else:
+            return len(gc.get_objects())
+
+    def record(self, view_name, growth):
+        self.by_view.setdefault(view_name, []).append(growth)
+
+    def largest(self, limit=20):
+        """
+        Returns a list of (view_name, measurements, total_growth) for the
+        views that have retained the most memory in total.
+        """
+
+        rows = [(view_name, len(growths), sum(growths))
+            for view_name, growths in self.by_view.iteritems()]
+        return sorted(rows, key=lambda row: -row[2])[:limit]
+
+    def format(self, limit=20):
+        lines = ["%-50s %8s %12s" % ("view", "runs", "growth (%s)" %
+            self.unit)]
+
+        for view_name, runs, growth in self.largest(limit):
+            lines.append("%-50s %8d %12.1f" % (view_name, runs, growth))
+
+        return "\n".join(lines)
+
+memory_growth_tracker = MemoryGrowthTracker()
@@ -81,3 +81,5 @@ class override_settings(object):
 def root_urlconf_changed(**kwargs):
     if kwargs['setting'] == 'ROOT_URLCONF':
         clear_url_caches()
+        from django_harness.fast_dispatch import clear_resolver_cache
+        clear_resolver_cache()
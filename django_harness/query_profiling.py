@@ -0,0 +1,211 @@
+from __future__ import unicode_literals, absolute_import
+
+import collections
+import os
+import re
+import sysconfig
+import traceback
+from timeit import default_timer
+
+import django
+from django.db.backends.util import CursorWrapper
+
+CapturedQuery = collections.namedtuple("CapturedQuery",
+    ["alias", "sql", "shape", "duration", "stack"])
+
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number_literal = re.compile(r"\b\d+(?:\.\d+)?\b")
+_placeholder_list = re.compile(r"\((?:\s*(?:%s|\?)\s*,)*\s*(?:%s|\?)\s*\)")
+
+def normalize_sql(sql):
+    """
+    Reduce a query to its shape, by replacing literals and placeholders
+    with ?, and collapsing lists of them (as used by IN clauses) into (...),
+    so that queries which differ only in their parameters look the same.
+    """
+
+    shape = _string_literal.sub("?", sql)
+    shape = _number_literal.sub("?", shape)
+    shape = _placeholder_list.sub("(...)", shape.replace("%s", "?"))
+    return re.sub(r"\s+", " ", shape).strip()
+
+_ignored_dirs = (
+    os.path.dirname(django.__file__),
+    os.path.dirname(__file__),
+)
+
+# The standard library (unittest, contextlib, etc.), except for installed
+# packages, which may live inside it.
+_stdlib_dirs = tuple(set([
+    os.path.dirname(os.__file__),
+    sysconfig.get_paths()['stdlib'],
+]))
+_package_dirs = tuple(set([
+    sysconfig.get_paths()['purelib'],
+    sysconfig.get_paths()['platlib'],
+]))
+
+def is_own_frame(filename):
+    if filename.startswith(_ignored_dirs):
+        return False
+    return (not filename.startswith(_stdlib_dirs) or
+        filename.startswith(_package_dirs))
+
+def get_caller_stack(limit=5):
+    """
+    Returns the innermost frames of the current stack that aren't in Django,
+    django_harness or the standard library, which should show which application code issued a
+    query. If there aren't any (e.g. the query was issued by a template)
+    then we return the innermost frames of the whole stack instead.
+    """
+
+    stack = traceback.extract_stack()[:-2]
+    own_frames = [frame for frame in stack if is_own_frame(frame[0])]
+    return (own_frames or stack)[-limit:]
+
+class ProfilingCursorWrapper(object):
+    """
+    Wraps the cursor that the connection would otherwise have returned,
+    which may be a CursorDebugWrapper (e.g. inside assertNumQueries), and
+    tells a QueryProfiler about each query, with the stack that issued it.
+    """
+
+    def __init__(self, cursor, db, profiler):
+        self.cursor = cursor
+        self.db = db
+        self.profiler = profiler
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=None):
+        start = default_timer()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.profiler.add_query(self.db.alias, sql,
+                default_timer() - start)
+
+    def executemany(self, sql, param_list):
+        start = default_timer()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.profiler.add_query(self.db.alias, sql,
+                default_timer() - start)
+
+class QueryProfiler(object):
+    """
+    Records every query executed on any of this thread's database
+    connections between start() and stop(), or inside a with block.
+    """
+
+    def __init__(self, stack_limit=5):
+        self.stack_limit = stack_limit
+        self.queries = []
+        self.saved_state = None
+
+    def add_query(self, alias, sql, duration):
+        self.queries.append(CapturedQuery(alias, sql, normalize_sql(sql),
+            duration, get_caller_stack(self.stack_limit)))
+
+    def start(self):
+        from django.conf import settings
+        from django.db import connections
+
+        self.saved_state = []
+
+        for connection in connections.all():
+            self.saved_state.append((connection, connection.use_debug_cursor))
+
+            # We force the connection to call make_debug_cursor, so we need to
+            # remember whether it would have done so without us.
+            was_debug = (connection.use_debug_cursor or
+                (connection.use_debug_cursor is None and settings.DEBUG))
+
+            def make_debug_cursor(cursor, connection=connection,
+                    was_debug=was_debug):
+                if was_debug:
+                    # the class method, not our instance override
+                    cursor = type(connection).make_debug_cursor(connection,
+                        cursor)
+                else:
+                    cursor = CursorWrapper(cursor, connection)
+                return ProfilingCursorWrapper(cursor, connection, self)
+
+            connection.make_debug_cursor = make_debug_cursor
+            connection.use_debug_cursor = True
+
+    def stop(self):
+        for connection, use_debug_cursor in self.saved_state:
+            del connection.make_debug_cursor
+            connection.use_debug_cursor = use_debug_cursor
+
+        self.saved_state = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def report(self, repeat_threshold=2):
+        return QueryReport(self.queries, repeat_threshold)
+
+class QueryReport(object):
+    """
+    The queries captured by a QueryProfiler, grouped by their shape.
+    Shapes that were executed at least repeat_threshold times are probably
+    N+1 patterns, where a query is run once for each object in a list.
+    """
+
+    def __init__(self, queries, repeat_threshold=2):
+        self.queries = queries
+        self.repeat_threshold = repeat_threshold
+
+        self.by_shape = collections.OrderedDict()
+        for query in queries:
+            self.by_shape.setdefault(query.shape, []).append(query)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(query.duration for query in self.queries)
+
+    @property
+    def repeated_shapes(self):
+        """
+        Returns a list of (shape, queries) for each shape that was executed
+        at least repeat_threshold times, most often first.
+        """
+
+        repeated = [(shape, queries)
+            for shape, queries in self.by_shape.iteritems()
+            if len(queries) >= self.repeat_threshold]
+        return sorted(repeated, key=lambda item: -len(item[1]))
+
+    def format(self):
+        lines = ["%d queries (%d distinct) in %.3fs" % (self.count,
+            len(self.by_shape), self.total_time)]
+
+        for shape, queries in self.repeated_shapes:
+            lines.append("")
+            lines.append("Repeated %d times: %s" % (len(queries), shape))
+            lines.append("First issued from:")
+            lines.extend(line.rstrip("\n") for line in
+                traceback.format_list(queries[0].stack))
+
+        return "\n".join(lines)
+
+    def __unicode__(self):
+        return self.format()
+
+    def __str__(self):
+        return self.format().encode('utf-8')
@@ -0,0 +1,271 @@
+from __future__ import unicode_literals, absolute_import
+
+import collections
+import threading
+from timeit import default_timer
+
+TemplateTiming = collections.namedtuple("TemplateTiming",
+    ["name", "depth", "elapsed", "self_time", "context_size"])
+
+def get_context_size(context):
+    """
+    The number of variables in all the layers of the context, counting
+    shadowed ones more than once.
+    """
+
+    return sum(len(layer) for layer in getattr(context, 'dicts', [context]))
+
+def get_inclusion_tag_name(node_class):
+    """
+    Returns a name for the template rendered by an inclusion tag, if
+    node_class is the InclusionNode class that Library.inclusion_tag
+    defines for each tag, or None if it's any other kind of node.
+
+    Inclusion tags render their template's nodelist directly, without
+    calling Template._render, so we have to time them separately, and
+    they only keep the template name in the closure of their render().
+    """
+
+    if (node_class.__name__ != 'InclusionNode' or
+            node_class.__module__ != 'django.template.base'):
+        return None
+
+    render = node_class.__dict__.get('render')
+    closure = getattr(render, '__closure__', None) or ()
+    cells = dict(zip(render.__code__.co_freevars,
+        [cell.cell_contents for cell in closure]))
+
+    file_name = cells.get('file_name')
+    if hasattr(file_name, 'nodelist'):
+        file_name = file_name.name
+    elif hasattr(file_name, '__iter__'):
+        file_name = ", ".join(file_name)
+
+    func = cells.get('func')
+    tag_name = getattr(func, '__name__', '?')
+    return "%s (inclusion tag %s)" % (file_name or '<unknown source>',
+        tag_name)
+
+# InclusionNode class => inclusion tag template name
+inclusion_tag_names = {}
+
+# Template._render and the render() of every InclusionNode class are
+# patched while any thread has a TemplateProfiler running, and the timings
+# go to the innermost running profiler in the current thread, if any.
+# Inclusion tags registered while the patches are installed are patched
+# too, by wrapping Library.inclusion_tag.
+patch_lock = threading.Lock()
+patch_count = 0
+original_methods = {}
+patched_inclusion_nodes = set()
+active_profilers = threading.local()
+
+def get_active_profiler():
+    stack = getattr(active_profilers, 'stack', None)
+    return stack[-1] if stack else None
+
+def get_patch_targets():
+    from django.template.base import Template, Library
+    return [(Template, '_render', timed_template_render),
+        (Library, 'inclusion_tag', timed_inclusion_tag)]
+
+def get_inclusion_node_classes(library):
+    """
+    Returns the InclusionNode classes of the inclusion tags registered in a
+    template Library, whose compile functions are partials of
+    generic_tag_compiler with the node_class as a keyword argument.
+    """
+
+    node_classes = []
+
+    for compile_func in library.tags.values():
+        keywords = getattr(compile_func, 'keywords', None) or {}
+        node_class = keywords.get('node_class')
+        if node_class is None:
+            continue
+
+        if node_class not in inclusion_tag_names:
+            inclusion_tag_names[node_class] = get_inclusion_tag_name(
+                node_class)
+        if inclusion_tag_names[node_class] is not None:
+            node_classes.append(node_class)
+
+    return node_classes
+
+def patch_inclusion_nodes(library):
+    for node_class in get_inclusion_node_classes(library):
+        if node_class not in patched_inclusion_nodes:
+            original_methods[(node_class, 'render')] = \
+                node_class.__dict__['render']
+            node_class.render = timed_inclusion_render
+            patched_inclusion_nodes.add(node_class)
+
+def install_patches():
+    from django.template.base import libraries, builtins
+
+    for cls, name, replacement in get_patch_targets():
+        original_methods[(cls, name)] = cls.__dict__[name]
+        setattr(cls, name, replacement)
+
+    for library in list(libraries.values()) + list(builtins):
+        patch_inclusion_nodes(library)
+
+def remove_patches():
+    # leave the originals in original_methods, for any thread that's still
+    # inside one of the replacements
+    for cls, name, replacement in get_patch_targets():
+        setattr(cls, name, original_methods[(cls, name)])
+
+    for node_class in patched_inclusion_nodes:
+        node_class.render = original_methods[(node_class, 'render')]
+    patched_inclusion_nodes.clear()
+
+def timed_template_render(template, context):
+    from django.template.base import Template
+    original_render = original_methods[(Template, '_render')]
+
+    profiler = get_active_profiler()
+    if profiler is None:
+        return original_render(template, context)
+
+    return profiler.time(template.name or '<unknown source>', context,
+        original_render, template, context)
+
+def timed_inclusion_render(node, context):
+    # InclusionNode.render is called directly by the nodes that contain it
+    # (e.g. ForNode), not always through NodeList.render_node.
+    node_class = node.__class__
+    original_render = original_methods[(node_class, 'render')]
+
+    profiler = get_active_profiler()
+    if profiler is None:
+        return original_render(node, context)
+
+    return profiler.time(inclusion_tag_names[node_class], context,
+        original_render, node, context)
+
+def timed_inclusion_tag(library, *args, **kwargs):
+    from django.template.base import Library
+    original_inclusion_tag = original_methods[(Library, 'inclusion_tag')]
+    dec = original_inclusion_tag(library, *args, **kwargs)
+
+    def timed_dec(func):
+        result = dec(func)
+        with patch_lock:
+            if patch_count > 0:
+                patch_inclusion_nodes(library)
+        return result
+
+    return timed_dec
+
+class TemplateProfiler(object):
+    """
+    Times every template rendered in this thread between start() and
+    stop(), or inside a with block, including included templates and
+    inclusion tags, by wrapping Template._render (which may already be
+    wrapped by the test environment to send the template_rendered signal,
+    which doesn't tell us the time) and the render() of inclusion tag nodes.
+
+    elapsed includes the time spent rendering nested templates, and
+    self_time excludes it. The timings are listed in the order in which the
+    templates finished rendering.
+
+    Profilers can run in several threads at once (e.g. in
+    fast_dispatch_concurrent), each seeing only its own thread's templates.
+    """
+
+    def __init__(self):
+        self.timings = []
+        self.depth = 0
+        self.nested_time = 0
+
+    def time(self, name, context, render, *args):
+        self.depth += 1
+        depth = self.depth
+        children_before = self.nested_time
+        start = default_timer()
+
+        try:
+            return render(*args)
+        finally:
+            elapsed = default_timer() - start
+            nested = self.nested_time - children_before
+            self.depth -= 1
+            self.nested_time = children_before + elapsed
+            self.timings.append(TemplateTiming(name, depth, elapsed,
+                elapsed - nested, get_context_size(context)))
+
+    def start(self):
+        global patch_count
+
+        with patch_lock:
+            if patch_count == 0:
+                install_patches()
+            patch_count += 1
+
+        if getattr(active_profilers, 'stack', None) is None:
+            active_profilers.stack = []
+        active_profilers.stack.append(self)
+
+    def stop(self):
+        global patch_count
+
+        active_profilers.stack.remove(self)
+
+        with patch_lock:
+            patch_count -= 1
+            if patch_count == 0:
+                remove_patches()
+
+        suite_template_timings.add(self.timings)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+class TemplateTimingStats(object):
+    """
+    Aggregated template timings for every TemplateProfiler that has run
+    in this process, e.g. for a whole test suite.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # name => [count, elapsed, self_time, max_elapsed]
+        self.by_name = {}
+
+    def add(self, timings):
+        for timing in timings:
+            stats = self.by_name.setdefault(timing.name, [0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += timing.elapsed
+            stats[2] += timing.self_time
+            stats[3] = max(stats[3], timing.elapsed)
+
+    def slowest(self, limit=20):
+        """
+        Returns a list of (name, count, elapsed, self_time, max_elapsed) for
+        the templates with the greatest total self_time.
+        """
+
+        rows = [(name,) + tuple(stats)
+            for name, stats in self.by_name.iteritems()]
+        return sorted(rows, key=lambda row: -row[3])[:limit]
+
+    def format(self, limit=20):
+        lines = ["%-50s %6s %10s %10s %10s" % ("template", "count",
+            "total ms", "self ms", "max ms")]
+
+        for name, count, elapsed, self_time, max_elapsed in \
+                self.slowest(limit):
+            lines.append("%-50s %6d %10.2f %10.2f %10.2f" % (name, count,
+                elapsed * 1000, self_time * 1000, max_elapsed * 1000))
+
+        return "\n".join(lines)
+
+suite_template_timings = TemplateTimingStats()